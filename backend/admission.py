@@ -0,0 +1,268 @@
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from contextlib import contextmanager, asynccontextmanager
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Work allowed in flight at once; 0 removes the limit. The LLM and embedding
+# limits start here and shrink (then slowly grow back) when the provider
+# answers with a rate-limit error.
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "64"))
+EMBEDDING_CONCURRENCY = int(os.environ.get("EMBEDDING_CONCURRENCY", "16"))
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "16"))
+EXEC_CONCURRENCY = int(os.environ.get("EXEC_CONCURRENCY", "8"))
+
+# Waiters allowed per limiter (beyond that: 503), per client and limiter
+# (beyond that: 429), and how long one may wait for a slot (then: 503).
+QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "128"))
+CLIENT_QUEUE_SIZE = int(os.environ.get("ADMISSION_CLIENT_QUEUE_SIZE", "16"))
+MAX_QUEUE_WAIT = float(os.environ.get("ADMISSION_MAX_QUEUE_WAIT", "10"))
+
+# Provider status codes that mean "slow down": rate limited, overloaded.
+RATE_LIMIT_STATUSES = (429, 529)
+MAX_RETRY_AFTER = 60
+
+# The client the current request is queued as (see set_client). Like the
+# request timings, it follows the request into the tasks and threads it starts.
+_client: contextvars.ContextVar[str] = contextvars.ContextVar("admission_client", default="")
+
+
+def set_client(request) -> str:
+    """Queues the current request under its X-Client-Id header, or else its address."""
+    client = request.headers.get("x-client-id") or (request.client.host if request.client else "")
+    _client.set(client)
+    return client
+
+
+class Overloaded(Exception):
+    """Raised when a request can't get a slot: the queue is full or the wait ran out."""
+
+    def __init__(self, stage: str, status: int, retry_after: int, reason: str):
+        super().__init__(f"Server busy ({stage}: {reason}). Retry in {retry_after}s.")
+        self.stage = stage
+        self.status = status
+        self.retry_after = retry_after
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    return getattr(error, "status_code", None) in RATE_LIMIT_STATUSES
+
+
+class Limiter:
+    """
+    A concurrency limit with a fair waiting line. Waiters queue per client
+    and free slots go to clients in round-robin order, so one busy client
+    can't starve the others. Full queues and waits longer than `max_wait`
+    raise `Overloaded`, with a Retry-After estimated from recent hold times.
+
+    With `adaptive` set, a rate-limit error from the work done under a slot
+    halves the limit (at most once per typical hold time) and every `limit`
+    successes grow it by one again, up to the configured value.
+    """
+
+    def __init__(self, stage: str, limit: int, adaptive: bool = False, queue_size: int = QUEUE_SIZE,
+                 client_queue_size: int = CLIENT_QUEUE_SIZE, max_wait: float = MAX_QUEUE_WAIT):
+        self.stage = stage
+        self.max_limit = limit
+        self.limit = limit
+        self.adaptive = adaptive
+        self.queue_size = queue_size
+        self.client_queue_size = client_queue_size
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._waiting: OrderedDict[str, deque[Future]] = OrderedDict()
+        self._queued = 0
+        self._hold_seconds = 1.0  # moving average
+        self._successes = 0
+        self._backoff_until = 0.0
+        metrics.CONCURRENCY_LIMIT.set(limit, stage=stage)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_limit > 0
+
+    def _retry_after(self) -> int:
+        seconds = self._hold_seconds * (self._queued + 1) / max(self.limit, 1)
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(seconds)))
+
+    def _reject(self, status: int, reason: str) -> Overloaded:
+        metrics.ADMISSION_REJECTED.inc(stage=self.stage, status=status)
+        return Overloaded(self.stage, status, self._retry_after(), reason)
+
+    def check(self):
+        """Raises `Overloaded` right away if a new request would be turned away."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._queued >= self.queue_size:
+                raise self._reject(503, "queue full")
+            waiters = self._waiting.get(_client.get())
+            if waiters and len(waiters) >= self.client_queue_size:
+                raise self._reject(429, "too many queued requests from this client")
+
+    def _enqueue(self) -> Future | None:
+        """Takes a free slot (returns None) or joins the client's line (returns the future to wait on)."""
+        client = _client.get()
+        with self._lock:
+            if self.in_flight < self.limit and not self._queued:
+                self.in_flight += 1
+                self._update_gauges()
+                return None
+            if self._queued >= self.queue_size:
+                raise self._reject(503, "queue full")
+            waiters = self._waiting.setdefault(client, deque())
+            if len(waiters) >= self.client_queue_size:
+                raise self._reject(429, "too many queued requests from this client")
+            future = Future()
+            waiters.append(future)
+            self._queued += 1
+            self._update_gauges()
+            return future
+
+    def _grant(self):
+        """Hands free slots to waiting clients in turn. Called with the lock held."""
+        while self.in_flight < self.limit and self._waiting:
+            client, waiters = next(iter(self._waiting.items()))
+            future = waiters.popleft()
+            if waiters:
+                self._waiting.move_to_end(client)
+            else:
+                del self._waiting[client]
+            self._queued -= 1
+            self.in_flight += 1
+            future.set_result(None)
+        self._update_gauges()
+
+    def _abandon(self, future: Future) -> bool:
+        """Leaves the line after a timeout or cancellation. Returns True if the slot was granted meanwhile."""
+        client = _client.get()
+        with self._lock:
+            if future.done():
+                return True
+            waiters = self._waiting.get(client)
+            if waiters is not None and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._waiting[client]
+                self._queued -= 1
+            self._update_gauges()
+            return False
+
+    def _release(self, held: float, error: BaseException | None):
+        with self._lock:
+            self.in_flight -= 1
+            self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * held
+            if self.adaptive:
+                if error is not None and is_rate_limited(error):
+                    self._back_off()
+                elif error is None and self.limit < self.max_limit:
+                    self._successes += 1
+                    if self._successes >= self.limit:
+                        self.limit += 1
+                        self._successes = 0
+                        metrics.CONCURRENCY_LIMIT.set(self.limit, stage=self.stage)
+            self._grant()
+
+    def _back_off(self):
+        metrics.RATE_LIMITED.inc(stage=self.stage)
+        now = time.monotonic()
+        if now < self._backoff_until:
+            return
+        self.limit = max(1, self.limit // 2)
+        self._successes = 0
+        self._backoff_until = now + max(1.0, self._hold_seconds)
+        metrics.CONCURRENCY_LIMIT.set(self.limit, stage=self.stage)
+        log.warning("%s provider is rate limiting; concurrency limit lowered to %d", self.stage, self.limit)
+
+    def _update_gauges(self):
+        metrics.IN_FLIGHT.set(self.in_flight, stage=self.stage)
+        metrics.QUEUED.set(self._queued, stage=self.stage)
+
+    def _waited(self, started: float):
+        waited = time.perf_counter() - started
+        metrics.QUEUE_WAIT_SECONDS.observe(waited, stage=self.stage)
+        if waited >= 0.001:
+            metrics.record("queue", waited, waiting_for=self.stage)
+
+    @contextmanager
+    def hold(self):
+        """Runs the block under a slot, waiting for one in line if needed."""
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        future = self._enqueue()
+        if future is not None:
+            try:
+                future.result(timeout=self.max_wait)
+            except FutureTimeout:
+                if not self._abandon(future):
+                    raise self._reject(503, f"no slot within {self.max_wait:g}s")
+        self._waited(started)
+
+        held = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self._release(time.perf_counter() - held, e)
+            raise
+        self._release(time.perf_counter() - held, None)
+
+    @asynccontextmanager
+    async def hold_async(self):
+        """Async variant of `hold`; waiting doesn't block the event loop."""
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        future = self._enqueue()
+        if future is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.max_wait)
+            except asyncio.TimeoutError:
+                if not self._abandon(future):
+                    raise self._reject(503, f"no slot within {self.max_wait:g}s")
+            except asyncio.CancelledError:
+                if self._abandon(future):
+                    self._release(0.0, None)
+                raise
+        self._waited(started)
+
+        held = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self._release(time.perf_counter() - held, e)
+            raise
+        self._release(time.perf_counter() - held, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "max_limit": self.max_limit,
+                "in_flight": self.in_flight,
+                "queued": self._queued,
+                "clients_waiting": len(self._waiting),
+            }
+
+
+REQUESTS = Limiter("request", MAX_CONCURRENT_REQUESTS)
+EMBEDDING = Limiter("embedding", EMBEDDING_CONCURRENCY, adaptive=True)
+LLM = Limiter("llm", LLM_CONCURRENCY, adaptive=True)
+EXECUTION = Limiter("execute", EXEC_CONCURRENCY)
+
+LIMITERS = [REQUESTS, EMBEDDING, LLM, EXECUTION]
+
+
+def stats() -> dict:
+    return {limiter.stage: limiter.stats() for limiter in LIMITERS}
@@ -1,114 +1,713 @@
-import json, textwrap, subprocess, tempfile, sys
+import os, re, json, time, logging, textwrap, asyncio
+from dataclasses import dataclass
 from pathlib import Path
-from jinja2 import Template
+from jinja2 import Environment, FileSystemLoader
 import llm
+import background
 import rag
+import sandbox
+import code_cache
+import metrics
+import singleflight
+import admission
+import triage
 
-# 1️⃣ Very-naïve intent → API classifier (keyword match for MVP)
-API_MAP = {
-    "weather": "open_meteo",
-    "temperature": "open_meteo",
-    "country": "rest_countries",
-    "bitcoin": "coingecko",
-    "crypto": "coingecko",
-    "joke": "jokeapi",
-    "bored": "boredapi",
-    "cat": "catfacts",
-    "advice": "adviceslip",
-    "number": "numbersapi",
-    "holiday": "nagerdate",
-    "ip": "ipify",
+log = logging.getLogger(__name__)
+
+# 1️⃣ Intent → API classifier. Each API has weighted keyword patterns and,
+# where its template would otherwise silently fall back to a default value
+# (NYC weather, US holidays, ...), a pattern the query must contain.
+API_PATTERNS = {
+    "open_meteo": ([(r"\bweather\b", 1.0), (r"\btemperature\b", 1.0), (r"\bforecast\b", 1.0),
+                    (r"\b(rain|sunny|wind|hot|cold)\b", 0.5)],
+                   r"-?\d+\.?\d*,\s*-?\d+\.?\d*"),
+    "rest_countries": ([(r"\bcountry\b", 1.0), (r"\bcapital\b", 0.5), (r"\bpopulation\b", 0.5)],
+                       r"^\s*\S+\s+.*\b[A-Z]"),
+    "coingecko": ([(r"\b(bitcoin|btc|ethereum|dogecoin|solana)\b", 1.0), (r"\bcrypto", 1.0), (r"\bprice\b", 0.5)],
+                  r"(?i)\b(bitcoin|btc|ethereum|dogecoin|solana)\b"),
+    "jokeapi": ([(r"\bjokes?\b", 1.0), (r"\bfunny\b", 0.5)], None),
+    "boredapi": ([(r"\bbored\b", 1.0), (r"\bactivity\b", 0.5), (r"\bsomething to do\b", 0.5)], None),
+    "catfacts": ([(r"\bcats?\b", 1.0), (r"\bfacts?\b", 0.3)], None),
+    "adviceslip": ([(r"\badvice\b", 1.0)], None),
+    "numbersapi": ([(r"\bnumber\b", 1.0), (r"\btrivia\b", 0.5)], r"\d+"),
+    "nagerdate": ([(r"\bholidays?\b", 1.0)], r"\b[A-Z]{2}\b"),
+    "ipify": ([(r"\bip\b", 1.0), (r"\bip address\b", 0.5)], None),
+}
+
+_COMPILED_PATTERNS = {
+    api: ([(re.compile(p, re.IGNORECASE), w) for p, w in keywords], re.compile(requires) if requires else None)
+    for api, (keywords, requires) in API_PATTERNS.items()
 }
 
+# A template is only served when the best API scores at least TEMPLATE_MIN_SCORE
+# and holds TEMPLATE_CONFIDENCE of the combined best + runner-up score.
+TEMPLATE_MIN_SCORE = 1.0
+TEMPLATE_CONFIDENCE = float(os.environ.get("TEMPLATE_CONFIDENCE", "0.75"))
+
+def score_apis(user_query: str) -> list[tuple[str, float]]:
+    """Scores every API against the query, best first. APIs scoring 0 are omitted."""
+    scores = []
+    for api, (keywords, requires) in _COMPILED_PATTERNS.items():
+        score = sum(weight for pattern, weight in keywords if pattern.search(user_query))
+        if score and requires is not None and not requires.search(user_query):
+            score = 0.0
+        if score:
+            scores.append((api, score))
+    return sorted(scores, key=lambda s: s[1], reverse=True)
+
+def match_api(user_query: str) -> tuple[str | None, float]:
+    """Returns (api, confidence), with api None when no template is a confident match."""
+    scores = score_apis(user_query)
+    if not scores or scores[0][1] < TEMPLATE_MIN_SCORE:
+        return None, 0.0
+    best = scores[0][1]
+    runner_up = scores[1][1] if len(scores) > 1 else 0.0
+    confidence = best / (best + runner_up)
+    if confidence < TEMPLATE_CONFIDENCE:
+        return None, confidence
+    return scores[0][0], confidence
+
 def pick_api(user_query:str) -> str|None:
-    for k, api in API_MAP.items():
-        if k in user_query.lower():
-            return api
-    return None
+    return match_api(user_query)[0]
+
+# 2️⃣ Boilerplate generator. Templates are compiled once and kept in memory.
+_templates = Environment(
+    loader=FileSystemLoader(Path(__file__).parent / "api_templates"),
+    auto_reload=False,
+    cache_size=-1,
+)
+
+def compile_templates():
+    """Compiles every API template up front so the first request doesn't pay for it."""
+    for api_name in API_PATTERNS:
+        _templates.get_template(f"{api_name}.py.j2")
 
-# 2️⃣ Boilerplate generator
 def build_code(api_name:str, user_query:str) -> str:
-    tpl_path = Path(__file__).parent / "api_templates" / f"{api_name}.py.j2"
-    tpl = Template(tpl_path.read_text())
-    return tpl.render(query=user_query)
+    return _templates.get_template(f"{api_name}.py.j2").render(query=user_query)
+
+def _output_succeeded(output: str) -> bool:
+    """
+    A clean exit that printed a JSON result other than {"error": ...}
+    (templates and generated scripts catch their own errors and print them that way).
+    """
+    if "Error executing code:" in output:
+        return False
+    try:
+        data = json.loads(output)
+    except json.JSONDecodeError:
+        return False
+    return not (isinstance(data, dict) and "error" in data)
+
+# 3️⃣ Query planner. A query naming several APIs ("weather in Berlin and
+# bitcoin price") is split at conjunctions into one sub-task per API; the
+# sub-tasks run through the pipeline concurrently and their outputs are merged.
+MAX_SUBTASKS = 4
+_CLAUSE_SEPARATOR = re.compile(r"(\s*(?:;|&|,(?!\s*-?\d)|\band\b|\bplus\b|\balso\b)\s*)", re.IGNORECASE)
+
+def _clause_api(clause: str) -> str | None:
+    """The API a clause is clearly about, by keyword score or else a decisive BM25 match."""
+    scores = score_apis(clause)
+    if scores and scores[0][1] >= TEMPLATE_MIN_SCORE:
+        return scores[0][0]
+    return rag.lexical_match(clause)
+
+def plan_query(user_query: str) -> list[str]:
+    """
+    Returns the sub-task queries of a multi-API query, or [] when it is about
+    a single API. A clause that names no API, or the same API as the clause
+    before it, stays part of that clause ("tell me about Bosnia and
+    Herzegovina" is one task).
+    """
+    parts = _CLAUSE_SEPARATOR.split(user_query)
+    subtasks: list[list] = []  # [text, api]
+    for i in range(0, len(parts), 2):
+        clause = parts[i].strip()
+        if not clause:
+            continue
+        api = _clause_api(clause)
+        if subtasks and (api is None or subtasks[-1][1] in (None, api)):
+            subtasks[-1][0] += parts[i - 1] + clause
+            subtasks[-1][1] = subtasks[-1][1] or api
+        else:
+            subtasks.append([clause, api])
+    if len(subtasks) < 2 or len(subtasks) > MAX_SUBTASKS or any(api is None for _, api in subtasks):
+        return []
+    return [text for text, _ in subtasks]
+
+def _subtask_status(result: dict) -> str:
+    return "ok" if "error" not in result and _output_succeeded(result.get("result", "")) else "error"
+
+def _merge_subtasks(subtasks: list[str], results: list[dict]) -> dict:
+    """
+    One result for a planned query: `result` is a JSON document with each
+    sub-task's query, status and parsed output (or error), `code` holds every
+    sub-task's script, and `subtasks` the full per-sub-task results.
+    """
+    merged = []
+    for query, result in zip(subtasks, results):
+        entry = {"query": query, "status": _subtask_status(result)}
+        if "error" in result:
+            entry["error"] = result["error"]
+        else:
+            try:
+                entry["result"] = json.loads(result.get("result", ""))
+            except json.JSONDecodeError:
+                entry["result"] = result.get("result", "")
+        merged.append(entry)
+    code = "\n\n".join(
+        f"# Sub-task {i + 1}: {query}\n{result.get('code', '')}" for i, (query, result) in enumerate(zip(subtasks, results))
+    )
+    return {
+        "code": code,
+        "result": json.dumps({"subtasks": merged}, indent=2),
+        "tier": "plan",
+        "subtasks": [{"query": query, "status": _subtask_status(result), **result} for query, result in zip(subtasks, results)],
+    }
 
 MAX_RETRIES = 2
+EXEC_TIMEOUT = 15 # Increased timeout for potentially complex code
+
+# Failed runs are triaged before Claude is asked for a fix (see triage.py):
+# transient failures are re-run with exponential backoff and mechanical ones
+# repaired locally, up to these limits per execution.
+TRANSIENT_RETRIES = 2
+TRANSIENT_BACKOFF = 0.5  # seconds, doubled per re-run
+LOCAL_REPAIRS = 2
+
+# Speculative mode: candidates vary by sampling temperature and by which of the
+# top retrieved docs they see (both lists are cycled through per candidate).
+MAX_SPECULATIVE_CANDIDATES = 6
+SPECULATIVE_TEMPERATURES = (0.0, 0.4, 0.8)
+SPECULATIVE_TOP_K = 3
+
+# How many queries of a /chat/batch request are generated and executed at once.
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "8"))
+# Most queries one /chat/batch request may carry; the batch holds a single
+# request slot, so this bounds what one client can queue behind it.
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "100"))
+
+@dataclass
+class SpeculationBudget:
+    """Per-request limits for speculative mode."""
+    candidates: int = 3
+    # Wall-clock seconds for the whole speculative round; None means each
+    # candidate is only bounded by the LLM call and EXEC_TIMEOUT.
+    deadline: float | None = None
+
+def _doc_variants(retrieved_docs: list[dict]) -> list[list[dict]]:
+    """Top-2 docs, then each of the top docs on its own."""
+    variants = [retrieved_docs[:2]] + [[doc] for doc in retrieved_docs]
+    return variants if len(retrieved_docs) > 1 else [retrieved_docs]
+
+def _format_result(result: sandbox.ExecResult) -> str:
+    if result.timed_out:
+        return f"Error executing code:\nTimed out after {EXEC_TIMEOUT} seconds\n--- STDOUT ---\n{result.stdout}\n--- STDERR ---\n{result.stderr}"
+
+    if result.returncode != 0:
+        # If there's a non-zero exit code, we treat it as an error
+        return f"Error executing code:\nExit Code: {result.returncode}\n--- STDOUT ---\n{result.stdout}\n--- STDERR ---\n{result.stderr}"
+
+    return result.stdout
+
+def _record_execution(result: sandbox.ExecResult, started: float):
+    metrics.record(
+        "execute", time.perf_counter() - started,
+        mode=result.mode, spawn_ms=round(result.spawn_seconds * 1000, 2), timed_out=result.timed_out,
+    )
 
 def run_code(code: str) -> str:
-    """Executes a string of Python code and returns its stdout and stderr."""
-    with tempfile.NamedTemporaryFile("w", delete=False, suffix=".py", encoding='utf-8') as tf:
-        tf.write(code)
-        temp_filename = tf.name
-    
+    """Executes a string of Python code and returns its stdout (or an error report with stdout and stderr)."""
+    with admission.EXECUTION.hold():
+        started = time.perf_counter()
+        result = sandbox.execute(code, timeout=EXEC_TIMEOUT)
+    _record_execution(result, started)
+    return _format_result(result)
+
+async def run_code_async(code: str) -> str:
+    """Async variant of `run_code`."""
+    async with admission.EXECUTION.hold_async():
+        started = time.perf_counter()
+        result = await sandbox.execute_async(code, timeout=EXEC_TIMEOUT)
+    _record_execution(result, started)
+    return _format_result(result)
+
+def _next_action(verdict: triage.Triage, reruns: int, repairs: int) -> str | None:
+    """"rerun", "repair" or None (stop: the output is fine or only Claude can fix it), counting the verdict."""
+    if verdict.kind == "ok":
+        return None
+    metrics.ERROR_TRIAGE.inc(kind=verdict.kind)
+    if verdict.kind == "transient" and reruns < TRANSIENT_RETRIES:
+        return "rerun"
+    if verdict.kind == "mechanical" and repairs < LOCAL_REPAIRS:
+        return "repair"
+    return None
+
+def _count_avoided(first: triage.Triage | None, output: str):
+    # A failed run that ended up succeeding without going back to Claude.
+    if first is not None and first.kind != "ok" and _output_succeeded(output):
+        metrics.LLM_RETRIES_AVOIDED.inc(kind=first.kind)
+
+def _keep_result(result: dict) -> bool:
+    """Only successful results are shared with identical requests after the run finishes."""
+    return "error" not in result and "Error executing code:" not in result.get("result", "")
+
+# Identical concurrent queries share one pipeline run (see singleflight.SingleFlight).
+_flights = singleflight.SingleFlight(keep=_keep_result) if singleflight.COALESCE_ENABLED else None
+
+def _coalesce_key(user_query: str) -> str:
+    # Only the same query (ignoring case and spacing) shares a run, and only on the same template path.
+    return f"{match_api(user_query)[0]}|{' '.join(user_query.lower().split())}"
+
+def coalescing_stats() -> dict:
+    """In-flight and shared-result counts of request coalescing."""
+    return _flights.stats() if _flights else {"enabled": False}
+
+def _finish_request(result: dict, request: metrics.Timings, include_timings: bool) -> dict:
+    """Records the request in the metrics and, if asked for, attaches its per-stage breakdown."""
+    tier = "error" if "error" in result else result.get("tier", "llm")
+    metrics.record_request(tier, request.elapsed())
+    if include_timings:
+        result = {**result, "timings": request.summary()}
+    return result
+
+# Blocking callers (scripts, worker threads) run the async pipeline on one
+# shared background event loop, so there is a single pipeline implementation.
+def handle_query(user_query: str, timings: bool = False) -> dict:
+    """
+    Handles a user query by retrieving relevant APIs, generating code,
+    executing it, and retrying on failure. With `timings` the result also
+    carries a per-stage latency breakdown. Raises `admission.Overloaded`
+    when the server is too busy to take the request.
+
+    Blocking wrapper around `handle_query_async`; don't call it from a
+    running event loop (await `handle_query_async` there instead).
+    """
+    return background.run(handle_query_async(user_query, timings=timings))
+
+def _event(name: str, **data) -> dict:
+    return {"event": name, "data": data}
+
+async def _generate_events(stream: bool, user_query: str, retrieved_docs: list[dict],
+                           old_code: str | None = None, error: str | None = None):
+    """Yields `token` events while Claude writes (stream mode only), then the extracted `code`."""
+    if not stream:
+        if old_code is None:
+            code = await llm.generate_code_async(user_query, retrieved_docs)
+        else:
+            code = await llm.generate_code_with_retry_async(
+                old_code=old_code, error=error, user_query=user_query, retrieved_docs=retrieved_docs
+            )
+        yield _event("code", code=code)
+        return
+
+    if old_code is None:
+        tokens = llm.stream_code_async(user_query, retrieved_docs)
+    else:
+        tokens = llm.stream_code_with_retry_async(old_code, error, user_query, retrieved_docs)
+    response = []
+    async for text in tokens:
+        response.append(text)
+        yield _event("token", text=text)
+    yield _event("code", code=llm.extract_code("".join(response)))
+
+async def _execute_events(stream: bool, code: str, attempt: int):
+    """Yields `exec_start`, live `stdout`/`stderr` chunks (stream mode only), then `executed`."""
+    yield _event("exec_start", attempt=attempt)
+    if not stream:
+        output = await run_code_async(code)
+    else:
+        async with admission.EXECUTION.hold_async():
+            started = time.perf_counter()
+            async for kind, payload in sandbox.stream_execute(code, EXEC_TIMEOUT):
+                if kind == "result":
+                    _record_execution(payload, started)
+                    output = _format_result(payload)
+                else:
+                    yield _event(kind, text=payload)
+    yield _event("executed", output=output)
+
+async def _triaged_execute_events(stream: bool, code: str, attempt: int):
+    """
+    `_execute_events` with transient failures re-run after a backoff and
+    mechanical failures repaired locally (see triage.py): yields a `triage`
+    event for each failure handled locally (and `code` when it was repaired),
+    and ends with one `executed` event carrying the final output and code and
+    the triage `kind` of that output.
+    """
+    async for event in _execute_events(stream, code, attempt):
+        if event["event"] != "executed":
+            yield event
+    output = event["data"]["output"]
+    first = None
+    reruns = repairs = 0
+    while True:
+        verdict = triage.triage(code, output)
+        first = first or verdict
+        action = _next_action(verdict, reruns, repairs)
+        if action is None:
+            break
+        log.info("Run failed (%s: %s); %s locally", verdict.kind, verdict.reason, action)
+        yield _event("triage", kind=verdict.kind, reason=verdict.reason, action=action)
+        if action == "rerun":
+            await asyncio.sleep(TRANSIENT_BACKOFF * 2 ** reruns)
+            reruns += 1
+        else:
+            repairs += 1
+            if verdict.output is not None:
+                output = verdict.output
+                continue
+            code = verdict.code
+            yield _event("code", code=code)
+        async for event in _execute_events(stream, code, attempt):
+            if event["event"] != "executed":
+                yield event
+        output = event["data"]["output"]
+    _count_avoided(first, output)
+    yield _event("executed", output=output, code=code, kind=verdict.kind)
+
+async def _speculate_events(user_query: str, retrieved_docs: list[dict], budget: SpeculationBudget):
+    """
+    Generates and executes `budget.candidates` scripts concurrently and takes
+    the first one that exits cleanly with a JSON result; the others are
+    cancelled (their LLM calls aborted, their scripts killed). Yields
+    `speculating` and `candidate_failed` events and ends with `result`.
+    """
+    variants = _doc_variants(retrieved_docs)
+    plans = [
+        (variants[i % len(variants)], SPECULATIVE_TEMPERATURES[i % len(SPECULATIVE_TEMPERATURES)])
+        for i in range(budget.candidates)
+    ]
+    yield _event("speculating", candidates=[
+        {"docs": [doc.get("name", "N/A") for doc in docs], "temperature": temperature}
+        for docs, temperature in plans
+    ])
+
+    async def candidate(index: int, docs: list[dict], temperature: float):
+        code = await llm.generate_code_async(user_query, docs, temperature=temperature)
+        return index, docs, code, await run_code_async(code)
+
+    tasks = [asyncio.create_task(candidate(i, docs, t)) for i, (docs, t) in enumerate(plans)]
+    winner = last = failure = None
+    deadline_reached = False
     try:
-        proc = subprocess.run(
-            [sys.executable, temp_filename], 
-            capture_output=True, 
-            text=True, 
-            timeout=15, # Increased timeout for potentially complex code
-            check=False 
-        )
-        
-        if proc.returncode != 0:
-            # If there's a non-zero exit code, we treat it as an error
-            return f"Error executing code:\nExit Code: {proc.returncode}\n--- STDOUT ---\n{proc.stdout}\n--- STDERR ---\n{proc.stderr}"
-        
-        return proc.stdout
+        for next_done in asyncio.as_completed(tasks, timeout=budget.deadline):
+            try:
+                index, docs, code, output = await next_done
+            except asyncio.TimeoutError:
+                raise
+            except Exception as e:
+                log.warning("Speculative candidate failed: %s", e)
+                failure = e
+                yield _event("candidate_failed", error=str(e))
+                continue
+            if _output_succeeded(output):
+                winner = (index, docs, code, output)
+                break
+            last = (index, docs, code, output)
+            yield _event("candidate_failed", index=index, error=output)
+    except asyncio.TimeoutError:
+        log.info("Speculation deadline of %ss reached", budget.deadline)
+        deadline_reached = True
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
+    if winner is None:
+        if last is None:
+            if failure is not None and not deadline_reached:
+                yield _event("result", error=f"Failed to generate code: {failure}")
+            else:
+                yield _event("result", error="No speculative candidate produced a result within the budget.")
+            return
+        index, docs, code, output = last
+        yield _event("result", code=code, result=output, tier="llm", speculative={"candidates": len(plans), "winner": None})
+        return
+
+    index, docs, code, output = winner
+    log.info("Speculative candidate %d won", index)
+    cache = await asyncio.to_thread(code_cache.get_cache)
+    if cache:
+        await asyncio.to_thread(cache.store, user_query, docs, code)
+    yield _event("result", code=code, result=output, tier="llm", speculative={"candidates": len(plans), "winner": index})
+
+async def _subtask_result(query: str) -> dict:
+    try:
+        if _flights:
+            return await _flights.run_async(_coalesce_key(query), lambda: _query_result(query, None, None, admit=False))
+        return await _query_result(query, None, None, admit=False)
+    except Exception as e:
+        log.error("Error handling sub-task '%s': %s", query, e)
+        return {"error": f"Failed to handle sub-task: {e}"}
+
+async def _plan_events(subtasks: list[str]):
+    """
+    Runs each sub-task through the pipeline concurrently (templates, cached
+    code and coalescing all apply per sub-task). Yields `plan`, then a
+    `subtask` event as each one finishes, and ends with the merged `result`.
+    """
+    yield _event("plan", subtasks=subtasks)
+
+    async def run(index: int, query: str) -> tuple[int, dict]:
+        return index, await _subtask_result(query)
+
+    tasks = [asyncio.create_task(run(i, query)) for i, query in enumerate(subtasks)]
+    results: list[dict] = [{}] * len(subtasks)
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            index, result = await next_done
+            results[index] = result
+            yield _event("subtask", index=index, query=subtasks[index],
+                         status=_subtask_status(result), tier=result.get("tier", "error"))
     finally:
-        import os
-        os.unlink(temp_filename)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    yield _event("result", **_merge_subtasks(subtasks, results))
 
-def handle_query(user_query: str) -> dict:
+async def stream_query(user_query: str, stream: bool = True, budget: SpeculationBudget | None = None,
+                       retrieved_docs: list[dict] | None = None, timings: bool = False):
     """
-    Handles a user query by retrieving relevant APIs, generating code,
-    executing it, and retrying on failure.
+    Async pipeline behind both /chat and /chat/stream. Yields stage events
+    (`plan`, `subtask`, `cache_hit`, `retrieved`, `token`, `code`, `exec_start`,
+    `stdout`, `stderr`, `triage`, `executed`, `retry`) and always ends with a `result` event
+    carrying the same dict `handle_query` returns. With `stream=False`
+    Claude's response and script output are not streamed. Passing a
+    `budget` replaces the serial generate/retry loop with a speculative round.
+    `retrieved_docs` skips retrieval when the caller already fetched them.
+    With `timings` the result also carries a per-stage latency breakdown.
     """
-    print(f"\n--- Handling query: {user_query} ---")
-    
+    request = metrics.start_request()
+    try:
+        async with admission.REQUESTS.hold_async():
+            async for event in _query_events(user_query, stream, budget, retrieved_docs):
+                if event["event"] == "result":
+                    event = _event("result", **_finish_request(event["data"], request, timings))
+                yield event
+    except admission.Overloaded as e:
+        # The response has already started, so report it in-band rather than as a 429/503.
+        yield _event("result", **_finish_request({"error": str(e), "retry_after": e.retry_after}, request, timings))
+
+async def _query_events(user_query: str, stream: bool, budget: SpeculationBudget | None,
+                        retrieved_docs: list[dict] | None):
+    # Results of queries that went through retrieval report which path found their docs.
+    retrieval = None
+    async for event in _pipeline_events(user_query, stream, budget, retrieved_docs):
+        if event["event"] == "retrieved":
+            retrieval = event["data"]["path"]
+        elif event["event"] == "result" and retrieval:
+            event = _event("result", **event["data"], retrieval=retrieval)
+        yield event
+
+async def _pipeline_events(user_query: str, stream: bool, budget: SpeculationBudget | None,
+                           retrieved_docs: list[dict] | None):
+    log.info("Handling query: %s", user_query)
+
+    # 0. Multi-API queries fan out into concurrent sub-tasks
+    # Blocking steps below (BM25 index, sqlite caches) run on a thread so the event loop keeps serving.
+    subtasks = await asyncio.to_thread(plan_query, user_query) if budget is None and retrieved_docs is None else []
+    if subtasks:
+        log.info("Planned %d sub-tasks: %s", len(subtasks), subtasks)
+        async for event in _plan_events(subtasks):
+            yield event
+        return
+
+    # 0a. Deterministic fast path: render a pre-compiled template, no LLM call
+    api_name, confidence = match_api(user_query)
+    if api_name:
+        log.info("Template match: %s (confidence %.2f)", api_name, confidence)
+        code = build_code(api_name, user_query)
+        yield _event("template", api=api_name, confidence=confidence, code=code)
+        async for event in _triaged_execute_events(stream, code, attempt=1):
+            yield event
+        code, output = event["data"]["code"], event["data"]["output"]
+        if _output_succeeded(output):
+            yield _event("result", code=code, result=output, tier="template")
+            return
+        log.info("Template failed; falling back to RAG + LLM")
+
+    # 0b. Serve previously successful code straight from the cache
+    cache = await asyncio.to_thread(code_cache.get_cache)
+    cached = await asyncio.to_thread(cache.lookup, user_query) if cache else None
+    if cached:
+        log.info("Code cache hit (docs: %s)", cached.doc_names)
+        yield _event("cache_hit", docs=cached.doc_names, code=cached.code)
+        async for event in _triaged_execute_events(stream, cached.code, attempt=1):
+            yield event
+        code, output = event["data"]["code"], event["data"]["output"]
+        if _output_succeeded(output):
+            yield _event("result", code=code, result=output, tier="cache")
+            return
+        log.info("Cached code failed; regenerating")
+        await asyncio.to_thread(cache.invalidate, user_query)
+
     # 1. Retrieve relevant API documentation
+    path = None  # docs passed in by the caller (a batch) were retrieved elsewhere
     try:
-        retrieved_docs = rag.retrieve(user_query)
+        if retrieved_docs is None:
+            k = SPECULATIVE_TOP_K if budget else 2
+            retrieved_docs, path = await rag.retrieve_with_path_async(user_query, k=k)
         if not retrieved_docs:
-            return {"error": "Could not find any relevant API documentation."}
+            yield _event("result", error="Could not find any relevant API documentation.")
+            return
+    except admission.Overloaded:
+        raise
     except Exception as e:
-        print(f"Error during RAG retrieval: {e}")
-        return {"error": f"Failed to retrieve API docs: {e}"}
+        log.error("Error during RAG retrieval: %s", e)
+        yield _event("result", error=f"Failed to retrieve API docs: {e}")
+        return
+    yield _event("retrieved", docs=[doc.get("name", "N/A") for doc in retrieved_docs], path=path)
+
+    if budget:
+        async for event in _speculate_events(user_query, retrieved_docs, budget):
+            yield event
+        return
 
     # 2. Generate initial code
     try:
-        code = llm.generate_code(user_query, retrieved_docs)
+        async for event in _generate_events(stream, user_query, retrieved_docs):
+            yield event
+        code = event["data"]["code"]
+    except admission.Overloaded:
+        raise
     except Exception as e:
-        print(f"Error during code generation: {e}")
-        return {"error": f"Failed to generate code: {e}"}
+        log.error("Error during code generation: %s", e)
+        yield _event("result", error=f"Failed to generate code: {e}")
+        return
 
     # 3. Execute code with retry logic
     output = ""
     for attempt in range(MAX_RETRIES + 1):
-        print(f"--- Attempt {attempt + 1} ---\nGenerated Code:\n{code}\n---")
-        output = run_code(code)
-        
-        # Check if the output indicates an error
+        log.debug("Attempt %d, generated code:\n%s", attempt + 1, code)
+        async for event in _triaged_execute_events(stream, code, attempt=attempt + 1):
+            yield event
+        code, output, kind = event["data"]["code"], event["data"]["output"], event["data"]["kind"]
+
         if "Error executing code:" not in output:
-            print("--- Code executed successfully ---")
-            return {"code": code, "result": output}
-        
-        # If it's the last attempt, return the error
+            log.info("Code executed successfully")
+            if cache and _output_succeeded(output):
+                await asyncio.to_thread(cache.store, user_query, retrieved_docs, code)
+            yield _event("result", code=code, result=output, tier="llm")
+            return
+
         if attempt >= MAX_RETRIES:
-            print("--- Max retries reached. Returning last error. ---")
+            log.warning("Max retries reached. Returning last error.")
+            break
+        if kind == "transient":
+            # Still failing after the reruns: the upstream is down, and rewriting the code won't help.
+            log.warning("Transient failure persisted after %d reruns. Returning last error.", TRANSIENT_RETRIES)
             break
 
-        # If there's an error, try to fix the code
+        metrics.RETRIES.inc()
+        yield _event("retry", attempt=attempt + 2, error=output)
         try:
-            code = llm.generate_code_with_retry(
-                old_code=code, 
-                error=output, 
-                user_query=user_query,
-                retrieved_docs=retrieved_docs
-            )
+            async for event in _generate_events(stream, user_query, retrieved_docs, old_code=code, error=output):
+                yield event
+            code = event["data"]["code"]
+        except admission.Overloaded:
+            raise
+        except Exception as e:
+            log.error("Error during code retry generation: %s", e)
+            yield _event("result", error=f"Failed to generate retry code: {e}", code=code, result=output, tier="llm")
+            return
+
+    yield _event("result", code=code, result=output, tier="llm")
+
+async def handle_query_async(user_query: str, budget: SpeculationBudget | None = None,
+                             retrieved_docs: list[dict] | None = None, timings: bool = False,
+                             admit: bool = True) -> dict:
+    """
+    Runs a query through the pipeline and returns its result: retrieval,
+    code generation and execution are awaited, so a single worker can hold
+    many chats in flight. Pass a `budget` to opt into speculative mode.
+    Non-speculative requests for the same query share one pipeline run. Raises
+    `admission.Overloaded` when the server is too busy to take the request;
+    `admit=False` skips the request-level limit (for callers already holding it).
+    """
+    request = metrics.start_request()
+    if _flights and budget is None:
+        result = await _flights.run_async(
+            _coalesce_key(user_query), lambda: _query_result(user_query, None, retrieved_docs, admit)
+        )
+    else:
+        result = await _query_result(user_query, budget, retrieved_docs, admit)
+    return _finish_request(result, request, timings)
+
+async def _query_result(user_query: str, budget: SpeculationBudget | None, retrieved_docs: list[dict] | None,
+                        admit: bool) -> dict:
+    if admit:
+        async with admission.REQUESTS.hold_async():
+            return await _query_result(user_query, budget, retrieved_docs, admit=False)
+    async for event in _query_events(user_query, False, budget, retrieved_docs):
+        if event["event"] == "result":
+            return event["data"]
+
+
+async def stream_batch(queries: list[str], concurrency: int = BATCH_CONCURRENCY):
+    """
+    Runs many queries through the pipeline and yields one result per input,
+    in input order, as `{"index", "query", **result}`. Identical queries are
+    answered once; queries without a template match share one batched
+    embeddings call and one batched vector query; generation and execution
+    then run with at most `concurrency` queries in flight. A failing query
+    only produces an `error` on its own item. The whole batch counts as one
+    request against the admission limit; the router caps its size at
+    MAX_BATCH_SIZE.
+    """
+    async with admission.REQUESTS.hold_async():
+        async for item in _batch_items(queries, concurrency):
+            yield item
+
+async def _batch_items(queries: list[str], concurrency: int):
+    unique = list(dict.fromkeys(query.strip() for query in queries if query.strip()))
+    log.info("Handling batch of %d queries (%d unique)", len(queries), len(unique))
+
+    # 1. Retrieve docs for everything a template or cached code won't answer, in one round trip
+    cache = await asyncio.to_thread(code_cache.get_cache)
+
+    def needs_docs_for(query: str) -> bool:
+        if match_api(query)[0] is not None or plan_query(query):
+            return False
+        return not (cache and cache.contains(query))
+
+    docs_by_query = {}
+    needs_docs = await asyncio.to_thread(lambda: [query for query in unique if needs_docs_for(query)])
+    if needs_docs:
+        try:
+            for query, docs in zip(needs_docs, await rag.retrieve_batch_async(needs_docs)):
+                docs_by_query[query] = docs
         except Exception as e:
-            print(f"Error during code retry generation: {e}")
-            return {"error": f"Failed to generate retry code: {e}", "code": code, "result": output}
+            # Each query falls back to retrieving on its own and reports its own error.
+            log.error("Error during batched RAG retrieval: %s", e)
+
+    # 2. Generate and execute with bounded concurrency
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(query: str) -> dict:
+        async with semaphore:
+            try:
+                return await handle_query_async(query, retrieved_docs=docs_by_query.get(query), admit=False)
+            except admission.Overloaded as e:
+                return {"error": str(e), "retry_after": e.retry_after}
+            except Exception as e:
+                log.error("Error handling batched query '%s': %s", query, e)
+                return {"error": f"Failed to handle query: {e}"}
+
+    tasks = {query: asyncio.create_task(run(query)) for query in unique}
+    try:
+        for index, query in enumerate(queries):
+            if not query.strip():
+                result = {"error": "Message cannot be empty."}
+            else:
+                result = await tasks[query.strip()]
+            yield {"index": index, "query": query, **result}
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+
 
-    # After loop, return the last result (which will be an error)
-    return {"code": code, "result": output} 
\ No newline at end of file
+async def handle_batch_async(queries: list[str], concurrency: int = BATCH_CONCURRENCY) -> list[dict]:
+    """Collects `stream_batch` into a list, in input order."""
+    return [item async for item in stream_batch(queries, concurrency)]
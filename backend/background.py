@@ -0,0 +1,25 @@
+import asyncio
+import threading
+
+# The blocking entry points kept for scripts (agent.handle_query,
+# llm.generate_code, ...) run their async counterparts on this one event loop,
+# in a daemon thread, so sync and async callers share a single code path.
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="background-loop", daemon=True).start()
+    return _loop
+
+
+def run(coro):
+    """
+    Runs `coro` on the background loop and blocks until it returns (or
+    raises). Don't call it from a running event loop: await `coro` there.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _background_loop()).result()
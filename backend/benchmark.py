@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import asyncio
+import argparse
+import tempfile
+import itertools
+import subprocess
+from pathlib import Path
+import httpx
+import numpy as np
+from db_models import load_api_docs
+from fake_services import FakeServices, FakeConfig
+
+BACKEND_DIR = Path(__file__).parent
+DOCS_DIR = BACKEND_DIR / "api_docs"
+RESULTS_DIR = Path(os.environ.get("BENCH_RESULTS_DIR", BACKEND_DIR / ".bench"))
+SERVER_START_TIMEOUT = 60
+
+
+def default_queries() -> list[str]:
+    """The example queries of every api_docs entry."""
+    return [example.user_query for doc in load_api_docs(DOCS_DIR).values() for example in doc.examples]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _git_commit() -> str:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain"], cwd=BACKEND_DIR, capture_output=True, text=True).stdout
+        return commit + ("-dirty" if dirty.strip() else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def server_env(fakes_url: str, workdir: Path, extra: dict[str, str]) -> dict[str, str]:
+    """Points the backend at the fakes and keeps its caches and index in a throwaway directory."""
+    return {
+        **os.environ,
+        "CLAUDE_API_KEY": "bench",
+        "ANTHROPIC_BASE_URL": fakes_url,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"{fakes_url}/v1",
+        "RETRIEVAL_BACKEND": "local",
+        "LOCAL_INDEX_DIR": str(workdir / "index"),
+        "CODE_CACHE_PATH": str(workdir / "code_cache.sqlite3"),
+        "EMBEDDING_CACHE_PATH": str(workdir / "embeddings.sqlite3"),
+        "EGRESS_PROXY_ENABLED": "1",
+        "EGRESS_UPSTREAM_OVERRIDE": fakes_url,
+        "LOG_LEVEL": "WARNING",
+        **extra,
+    }
+
+
+def start_server(env: dict[str, str], port: int, workers: int) -> subprocess.Popen:
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers),
+         "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env,
+    )
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Backend exited with code {proc.returncode} during startup")
+        try:
+            # Ready once the startup warm-up is done, so it isn't counted in the first requests' latency.
+            if httpx.get(f"http://127.0.0.1:{port}/health/ready", timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"Backend was not ready within {SERVER_START_TIMEOUT}s")
+
+
+async def run_load(url: str, queries: list[str], total: int, concurrency: int) -> tuple[list[dict], float]:
+    """Sends `total` /chat requests, `concurrency` at a time, cycling through `queries`."""
+    samples = []
+    next_query = itertools.cycle(queries)
+    remaining = iter(range(total))
+
+    async def worker(client: httpx.AsyncClient):
+        for _ in remaining:
+            query = next(next_query)
+            start = time.perf_counter()
+            try:
+                resp = await client.post(f"{url}/chat", json={"message": query, "timings": True})
+                body = resp.json()
+                status = resp.status_code
+            except (httpx.HTTPError, ValueError) as e:
+                body, status = {"error": str(e)}, None
+            latency = time.perf_counter() - start
+            failed = status != 200 or "error" in body or "Error executing code:" in str(body.get("result", ""))
+            samples.append({
+                "query": query,
+                "status": status,
+                "latency": latency,
+                "failed": failed,
+                "tier": body.get("tier", "error"),
+                "stages": body.get("timings", {}).get("stages", []),
+            })
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        duration = time.perf_counter() - start
+    return samples, duration
+
+
+def _percentiles(values: list[float]) -> dict:
+    ms = np.asarray(values) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(ms, 95)), 2),
+        "p99_ms": round(float(np.percentile(ms, 99)), 2),
+        "mean_ms": round(float(ms.mean()), 2),
+        "max_ms": round(float(ms.max()), 2),
+    }
+
+
+def summarize(samples: list[dict], duration: float, fake_stats: dict) -> dict:
+    tiers, stages = {}, {}
+    for sample in samples:
+        tiers[sample["tier"]] = tiers.get(sample["tier"], 0) + 1
+        for stage in sample["stages"]:
+            stages.setdefault(stage["stage"], []).append(stage["ms"] / 1000)
+    count = len(samples)
+    return {
+        "requests": count,
+        "failed": sum(sample["failed"] for sample in samples),
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(count / duration, 2) if duration else 0.0,
+        "latency": _percentiles([sample["latency"] for sample in samples]),
+        "tiers": tiers,
+        "stages": {name: {"count": len(values), **_percentiles(values)} for name, values in sorted(stages.items())},
+        "upstream_calls_per_request": {name: round(n / count, 3) for name, n in fake_stats["calls"].items()},
+        "llm_tokens_per_request": {kind: round(n / count, 1) for kind, n in fake_stats["tokens"].items()},
+    }
+
+
+def save_result(result: dict) -> Path:
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    path = RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{result['commit']}.json"
+    path.write_text(json.dumps(result, indent=2), encoding="utf-8")
+    return path
+
+
+def previous_result(config: dict, exclude: Path) -> dict | None:
+    """The most recent saved run with the same configuration."""
+    for path in sorted(RESULTS_DIR.glob("*.json"), reverse=True):
+        if path == exclude:
+            continue
+        try:
+            result = json.loads(path.read_text(encoding="utf-8"))
+        except ValueError:
+            continue
+        if result.get("config") == config:
+            return result
+    return None
+
+
+def report(result: dict, baseline: dict | None):
+    summary = result["summary"]
+    print(f"\nCommit {result['commit']}: {summary['requests']} requests in {summary['duration_s']}s, "
+          f"{summary['failed']} failed, tiers {summary['tiers']}")
+
+    def row(name: str, current: float, previous: float | None, unit: str):
+        line = f"  {name:<16}{current:>10.2f} {unit}"
+        if previous:
+            line += f"   ({(current - previous) / previous:+.1%} vs {baseline['commit']})"
+        print(line)
+
+    base = baseline["summary"] if baseline else None
+    row("throughput", summary["throughput_rps"], base and base["throughput_rps"], "req/s")
+    for key in ("p50_ms", "p95_ms", "p99_ms"):
+        row(f"latency {key[:3]}", summary["latency"][key], base and base["latency"][key], "ms")
+    print("  stages (p50 / p95 ms):")
+    for name, stats in summary["stages"].items():
+        print(f"    {name:<14}{stats['p50_ms']:>10.2f} /{stats['p95_ms']:>10.2f}   x{stats['count']}")
+    print(f"  calls per request: {summary['upstream_calls_per_request']}")
+
+
+def main(args: argparse.Namespace):
+    queries = default_queries()
+    if args.queries:
+        queries = [line.strip() for line in Path(args.queries).read_text(encoding="utf-8").splitlines() if line.strip()]
+
+    extra = dict(pair.split("=", 1) for pair in args.env)
+    if args.no_code_cache:
+        extra["CODE_CACHE_SIZE"] = "0"
+    config = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "workers": args.workers,
+        "llm_latency": args.llm_latency,
+        "embedding_latency": args.embedding_latency,
+        "upstream_latency": args.upstream_latency,
+        "queries": len(queries),
+        "env": extra,
+    }
+
+    fakes = FakeServices(FakeConfig(args.llm_latency, args.embedding_latency, args.upstream_latency))
+    fakes_url = fakes.start()
+    workdir = Path(tempfile.mkdtemp(prefix="bench-"))
+    server = None
+    try:
+        env = server_env(fakes_url, workdir, extra)
+        print("Building the local index against the fake embeddings API...")
+        subprocess.run(
+            [sys.executable, "index_docs.py", "--backend", "local", "--full"],
+            cwd=BACKEND_DIR, env=env, check=True, stdout=subprocess.DEVNULL,
+        )
+
+        port = _free_port()
+        print(f"Starting the backend on port {port} ({args.workers} worker(s))...")
+        server = start_server(env, port, args.workers)
+        url = f"http://127.0.0.1:{port}"
+
+        if args.warmup:
+            asyncio.run(run_load(url, queries, args.warmup, min(args.concurrency, args.warmup)))
+        before = fakes.stats()
+
+        print(f"Sending {args.requests} requests at concurrency {args.concurrency}...")
+        samples, duration = asyncio.run(run_load(url, queries, args.requests, args.concurrency))
+        after = fakes.stats()
+        fake_stats = {
+            group: {name: after[group][name] - before[group][name] for name in after[group]}
+            for group in after
+        }
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=10)
+        fakes.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": config,
+        "summary": summarize(samples, duration, fake_stats),
+    }
+    path = save_result(result)
+    report(result, previous_result(config, exclude=path))
+    print(f"\nSaved to {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load-test /chat against local fakes of Anthropic, OpenAI and the upstream APIs."
+    )
+    parser.add_argument("--requests", type=int, default=200, help="Requests to send (after warm-up).")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once.")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes.")
+    parser.add_argument("--warmup", type=int, default=20, help="Requests sent before measuring.")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="Seconds the fake Anthropic API takes per call.")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="Seconds per fake embeddings call.")
+    parser.add_argument("--upstream-latency", type=float, default=0.1, help="Seconds per fake upstream API call.")
+    parser.add_argument("--queries", help="File with one query per line (defaults to the api_docs examples).")
+    parser.add_argument("--no-code-cache", action="store_true", help="Disable the generated-code cache.")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment for the backend, e.g. --env SANDBOX_POOL_SIZE=8.")
+    main(parser.parse_args())
@@ -0,0 +1,176 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from db_models import STOPWORDS, docs_fingerprint, current_docs_fingerprint
+
+# A cache size of 0 disables the cache entirely.
+CACHE_SIZE = int(os.environ.get("CODE_CACHE_SIZE", "1000"))
+CACHE_PATH = os.environ.get(
+    "CODE_CACHE_PATH", str(Path(__file__).parent / ".cache" / "code_cache.sqlite3")
+)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Lowercases and strips punctuation and filler words. Word order and
+    repeats are kept: "100 usd to eur" and "100 eur to usd" differ.
+    """
+    terms = re.findall(r"-?[a-z0-9]+(?:[.'][a-z0-9]+)*", query.lower())
+    return " ".join(term for term in terms if term not in STOPWORDS)
+
+
+@dataclass
+class CachedCode:
+    query: str
+    doc_names: list[str]
+    code: str
+    fingerprint: str
+
+
+class CodeCache:
+    """
+    LRU cache of generated code that ran successfully (callers only store
+    scripts that printed a JSON result without an `error`), keyed on the
+    normalized query plus the names of the retrieved docs. Entries are
+    written through to sqlite so they survive restarts, and are dropped
+    once any file in api_docs/ changes.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, max_entries: int = CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, CachedCode] = OrderedDict()
+        self._latest: dict[str, str] = {}  # normalized query -> most recent key
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS code_cache ("
+            "key TEXT PRIMARY KEY, query TEXT, doc_names TEXT, code TEXT,"
+            " fingerprint TEXT, last_used REAL)"
+        )
+        self._load()
+
+    @staticmethod
+    def make_key(query: str, doc_names: list[str]) -> str:
+        return normalize_query(query) + "\x1f" + ",".join(sorted(doc_names))
+
+    def _load(self):
+        fingerprint = docs_fingerprint()
+        rows = self._db.execute(
+            "SELECT key, query, doc_names, code, fingerprint FROM code_cache ORDER BY last_used"
+        ).fetchall()
+        for key, query, doc_names, code, fp in rows:
+            if fp != fingerprint:
+                continue
+            self._entries[key] = CachedCode(query, json.loads(doc_names), code, fp)
+            self._latest[query] = key
+        # Purge stale rows and anything beyond capacity.
+        self._db.execute("DELETE FROM code_cache WHERE fingerprint != ?", (fingerprint,))
+        while len(self._entries) > self.max_entries:
+            self._evict_oldest()
+        self._db.commit()
+
+    def _evict_oldest(self):
+        key, entry = self._entries.popitem(last=False)
+        if self._latest.get(entry.query) == key:
+            del self._latest[entry.query]
+        self._db.execute("DELETE FROM code_cache WHERE key = ?", (key,))
+        self.evictions += 1
+
+    def lookup(self, query: str) -> CachedCode | None:
+        """Returns the most recently stored code for this query, if still valid."""
+        norm = normalize_query(query)
+        with self._lock:
+            key = self._latest.get(norm)
+            entry = self._entries.get(key) if key else None
+            if entry is not None and entry.fingerprint != current_docs_fingerprint():
+                self._drop(key)
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._db.execute("UPDATE code_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self.hits += 1
+            return entry
+
+    def contains(self, query: str) -> bool:
+        """Whether `lookup` would return code for this query; doesn't count as a hit or refresh the entry."""
+        with self._lock:
+            key = self._latest.get(normalize_query(query))
+            entry = self._entries.get(key) if key else None
+            return entry is not None and entry.fingerprint == current_docs_fingerprint()
+
+    def store(self, query: str, retrieved_docs: list[dict], code: str):
+        doc_names = [doc.get("name", "") for doc in retrieved_docs]
+        key = self.make_key(query, doc_names)
+        norm = normalize_query(query)
+        entry = CachedCode(norm, doc_names, code, current_docs_fingerprint())
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._latest[norm] = key
+            self._db.execute(
+                "INSERT OR REPLACE INTO code_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (key, norm, json.dumps(doc_names), code, entry.fingerprint, time.time()),
+            )
+            while len(self._entries) > self.max_entries:
+                self._evict_oldest()
+            self._db.commit()
+            self.stores += 1
+
+    def invalidate(self, query: str):
+        """Drops the cached code for a query, e.g. after it stopped working."""
+        with self._lock:
+            key = self._latest.get(normalize_query(query))
+            if key:
+                self._drop(key)
+                self._db.commit()
+                self.invalidations += 1
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None and self._latest.get(entry.query) == key:
+            del self._latest[entry.query]
+        self._db.execute("DELETE FROM code_cache WHERE key = ?", (key,))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+_cache: CodeCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> CodeCache | None:
+    """Returns the process-wide code cache, or None if it is disabled."""
+    global _cache
+    if CACHE_SIZE <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = CodeCache()
+    return _cache
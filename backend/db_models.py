@@ -1,6 +1,25 @@
+import os
+import time
+import yaml
+import logging
+import threading
+from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional
 
+log = logging.getLogger(__name__)
+
+DOCS_DIR = Path(__file__).parent / "api_docs"
+# Seconds between checks of api_docs/ for changes (a glob and a stat per doc).
+DOCS_CHECK_INTERVAL = float(os.environ.get("DOCS_CHECK_INTERVAL", "2"))
+
+# Filler words dropped from queries by the BM25 tokenizer and the code
+# cache, so "what's the price of bitcoin?" and "price of bitcoin" match.
+STOPWORDS = {
+    "a", "an", "the", "of", "for", "in", "on", "at", "to", "is", "are", "what",
+    "whats", "what's", "me", "my", "please", "show", "tell", "give", "get", "current",
+}
+
 class ApiExample(BaseModel):
     """Data model for a single API usage example."""
     user_query: str
@@ -12,4 +31,38 @@ class ApiDoc(BaseModel):
     description: str
     documentation_summary: Optional[str] = None
     base_url: str
-    examples: List[ApiExample] = Field(..., min_length=1) 
\ No newline at end of file
+    # Seconds the egress proxy may serve a cached response from this API's host (0 = never).
+    cache_ttl: int = 0
+    examples: List[ApiExample] = Field(..., min_length=1)
+
+def load_api_docs(docs_dir: Path) -> dict[str, ApiDoc]:
+    """Parses and validates every *.md file in docs_dir, keyed by file name without extension."""
+    docs = {}
+    for path in sorted(Path(docs_dir).glob("*.md")):
+        try:
+            # The first part of the file is YAML front matter
+            doc_data = yaml.safe_load(path.read_text(encoding="utf-8").strip('--- \n'))
+            docs[path.stem] = ApiDoc(**doc_data)
+        except Exception as e:
+            log.warning("Skipping invalid API doc %s: %s", path.name, e)
+    return docs
+
+def docs_fingerprint(docs_dir: Path = DOCS_DIR) -> str:
+    """A cheap fingerprint of the api_docs/*.md files, based on name, size and mtime."""
+    parts = []
+    for path in sorted(docs_dir.glob("*.md")):
+        st = path.stat()
+        parts.append(f"{path.name}:{st.st_size}:{st.st_mtime_ns}")
+    return "|".join(parts)
+
+_fingerprint: tuple[float, str] | None = None  # (checked at, fingerprint of DOCS_DIR)
+_fingerprint_lock = threading.Lock()
+
+def current_docs_fingerprint() -> str:
+    """`docs_fingerprint()` of api_docs/, recomputed at most every DOCS_CHECK_INTERVAL seconds."""
+    global _fingerprint
+    now = time.monotonic()
+    with _fingerprint_lock:
+        if _fingerprint is None or now - _fingerprint[0] >= DOCS_CHECK_INTERVAL:
+            _fingerprint = (now, docs_fingerprint())
+        return _fingerprint[1]
@@ -0,0 +1,260 @@
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+import httpx
+from db_models import load_api_docs
+
+# Set EGRESS_PROXY_ENABLED=0 to let generated scripts talk to upstream APIs directly.
+PROXY_ENABLED = os.environ.get("EGRESS_PROXY_ENABLED", "1") != "0"
+PROXY_CACHE_SIZE = int(os.environ.get("EGRESS_PROXY_CACHE_SIZE", "1024"))
+UPSTREAM_TIMEOUT = 10
+# Sends every upstream request to this base URL instead, with the real URL in
+# the X-Egress-Url header. benchmark.py uses it to point scripts at fake APIs.
+UPSTREAM_OVERRIDE = os.environ.get("EGRESS_UPSTREAM_OVERRIDE", "")
+DOCS_DIR = Path(__file__).parent / "api_docs"
+
+TARGET_HEADER = "x-egress-url"
+# Headers that describe a single hop (or that we recompute) and must not be forwarded.
+HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-connection", "transfer-encoding", "te", "trailer",
+    "upgrade", "host", "content-length", "content-encoding", "accept-encoding", TARGET_HEADER,
+}
+
+
+class UpstreamError(Exception):
+    """The upstream request failed without a response (connection error, timeout)."""
+
+
+@dataclass
+class UpstreamResponse:
+    status: int
+    reason: str
+    headers: list[tuple[str, str]]
+    body: bytes
+
+
+def load_ttls(docs_dir: Path = DOCS_DIR) -> dict[str, int]:
+    """Maps each upstream host to the `cache_ttl` configured in its api_docs entry."""
+    return {
+        httpx.URL(doc.base_url).host: doc.cache_ttl
+        for doc in load_api_docs(docs_dir).values()
+    }
+
+
+class EgressProxy:
+    """
+    A local HTTP gateway for sandboxed scripts (see sandbox_site/egress_hook.py).
+    Upstream requests share one pooled, keep-alive client; identical in-flight
+    GETs (same URL and request headers) are coalesced into a single upstream
+    call; and successful GETs are cached per host for the `cache_ttl`
+    configured in api_docs/*.md. When the upstream call fails without a
+    response, the script's connection is dropped so its HTTP client raises
+    a network error, as it would without the proxy.
+    The server runs on its own event loop in a daemon thread, so it serves the
+    sync and async request paths alike.
+    """
+
+    def __init__(self, ttls: dict[str, int] | None = None, max_entries: int = PROXY_CACHE_SIZE):
+        self.ttls = load_ttls() if ttls is None else ttls
+        self.max_entries = max_entries
+        self.port: int | None = None
+        self._cache: OrderedDict[str, tuple[float, UpstreamResponse]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._started = threading.Event()
+        self._error: BaseException | None = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.upstream_errors = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        threading.Thread(target=self._run, name="egress-proxy", daemon=True).start()
+        self._started.wait()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._serve())
+        except BaseException as e:
+            self._error = e
+            self._started.set()
+
+    async def _serve(self):
+        self._client = httpx.AsyncClient(
+            timeout=UPSTREAM_TIMEOUT,
+            limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+        )
+        server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = server.sockets[0].getsockname()[1]
+        self._started.set()
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, headers, body = request
+                target = next((v for k, v in headers if k.lower() == TARGET_HEADER), None)
+                if target is None:
+                    response = UpstreamResponse(400, "Bad Request", [], b"Missing X-Egress-Url header")
+                else:
+                    try:
+                        response = await self._dispatch(method, target, headers, body)
+                    except UpstreamError:
+                        writer.transport.abort()
+                        return
+                _write_response(writer, response, head_only=method == "HEAD")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, url: str, headers, body: bytes) -> UpstreamResponse:
+        if method != "GET":
+            return await self._fetch(method, url, headers, body)
+
+        key = _cache_key(url, headers)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            response = await self._fetch(method, url, headers, body)
+            ttl = self.ttls.get(httpx.URL(url).host, 0)
+            if ttl > 0 and response.status == 200:
+                self._cache[key] = (time.monotonic() + ttl, response)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+            future.set_result(response)
+            return response
+        except UpstreamError as e:
+            future.set_exception(e)
+            future.exception()  # waiters re-raise it; don't warn when there are none
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            del self._inflight[key]
+
+    async def _fetch(self, method: str, url: str, headers, body: bytes) -> UpstreamResponse:
+        forward = [(k, v) for k, v in headers if k.lower() not in HOP_HEADERS]
+        if UPSTREAM_OVERRIDE:
+            forward.append((TARGET_HEADER, url))
+            url = UPSTREAM_OVERRIDE
+        try:
+            resp = await self._client.request(method, url, headers=forward, content=body or None)
+        except Exception as e:
+            self.upstream_errors += 1
+            raise UpstreamError(str(e)) from e
+        return UpstreamResponse(
+            resp.status_code,
+            resp.reason_phrase,
+            [(k, v) for k, v in resp.headers.multi_items() if k.lower() not in HOP_HEADERS],
+            resp.content,
+        )
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "cached_responses": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "upstream_errors": self.upstream_errors,
+        }
+
+
+def _cache_key(url: str, headers) -> str:
+    """The URL plus the forwarded request headers: requests differing in Accept, auth, etc. don't share a response."""
+    forwarded = sorted((k.lower(), v) for k, v in headers if k.lower() not in HOP_HEADERS)
+    return "\n".join([url] + [f"{k}: {v}" for k, v in forwarded])
+
+
+async def _read_request(reader: asyncio.StreamReader):
+    """Reads one HTTP/1.1 request; returns None when the client closed the connection."""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    method = line.decode("latin-1").split()[0].upper()
+
+    headers = []
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers.append((name.strip(), value.strip()))
+
+    lookup = {k.lower(): v for k, v in headers}
+    if lookup.get("transfer-encoding", "").lower() == "chunked":
+        body = b""
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            body += await reader.readexactly(size)
+            await reader.readline()
+    else:
+        length = int(lookup.get("content-length", 0))
+        body = await reader.readexactly(length) if length else b""
+    return method, headers, body
+
+
+def _write_response(writer: asyncio.StreamWriter, response: UpstreamResponse, head_only: bool = False):
+    lines = [f"HTTP/1.1 {response.status} {response.reason}"]
+    lines += [f"{k}: {v}" for k, v in response.headers]
+    lines.append(f"Content-Length: {len(response.body)}")
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    if not head_only:
+        writer.write(response.body)
+
+
+_proxy: EgressProxy | None = None
+_proxy_lock = threading.Lock()
+
+
+def get_proxy() -> EgressProxy | None:
+    """Returns the process-wide egress proxy, starting it on first use."""
+    global _proxy
+    if not PROXY_ENABLED:
+        return None
+    with _proxy_lock:
+        if _proxy is None:
+            proxy = EgressProxy()
+            proxy.start()
+            _proxy = proxy
+    return _proxy
+
+
+def stats() -> dict:
+    """Counters of the running proxy, without starting one."""
+    if _proxy is None:
+        return {"enabled": PROXY_ENABLED, "running": False}
+    return {"enabled": True, "running": True, **_proxy.stats()}
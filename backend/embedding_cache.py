@@ -0,0 +1,120 @@
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+
+# In-memory entries; 0 disables the cache. An empty path disables the disk tier.
+CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "10000"))
+CACHE_PATH = os.environ.get(
+    "EMBEDDING_CACHE_PATH", str(Path(__file__).parent / ".cache" / "embeddings.sqlite3")
+)
+
+
+def normalize_text(text: str) -> str:
+    """Collapses whitespace (including newlines) the same way before embedding and lookup."""
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache of embeddings keyed by (model, normalized text).
+    Vectors are kept as float32 arrays in a bounded in-memory LRU, backed by
+    an optional sqlite file that every uvicorn worker (and index_docs.py)
+    shares, so a text is only ever sent to the embeddings API once.
+    """
+
+    def __init__(self, max_entries: int = CACHE_SIZE, path: str | None = CACHE_PATH):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db = None
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, vector BLOB)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\x1f{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def get(self, model: str, text: str) -> np.ndarray | None:
+        key = self.make_key(model, text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector
+
+            if self._db is not None:
+                row = self._db.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    vector = np.frombuffer(row[0], dtype=np.float32)
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                    return vector
+
+            self.misses += 1
+            return None
+
+    def put(self, model: str, text: str, vector) -> np.ndarray:
+        """Stores a vector and returns it as a read-only float32 array."""
+        vector = np.asarray(vector, dtype=np.float32)
+        vector.flags.writeable = False
+        key = self.make_key(model, text)
+        with self._lock:
+            self._remember(key, vector)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                    (key, model, vector.tobytes()),
+                )
+                self._db.commit()
+        return vector
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            disk_entries = None
+            if self._db is not None:
+                disk_entries = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "disk_entries": disk_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+_cache: EmbeddingCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> EmbeddingCache | None:
+    """Returns the process-wide embedding cache, or None if it is disabled."""
+    global _cache
+    if CACHE_SIZE <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+    return _cache
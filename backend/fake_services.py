@@ -0,0 +1,194 @@
+import re
+import json
+import time
+import base64
+import socket
+import asyncio
+import hashlib
+import threading
+from dataclasses import dataclass
+import httpx
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Canned responses of the ten upstream APIs in api_docs/, keyed by host.
+UPSTREAM_PAYLOADS = {
+    "api.adviceslip.com": {"slip": {"id": 42, "advice": "Don't benchmark against production."}},
+    "www.boredapi.com": {"activity": "Write a load test", "type": "busywork", "participants": 1, "key": "1"},
+    "catfact.ninja": {"fact": "Cats sleep for around 13 to 16 hours a day.", "length": 43},
+    "api.coingecko.com": {"bitcoin": {"usd": 60000}, "ethereum": {"usd": 3000}},
+    "api.ipify.org": {"ip": "203.0.113.7"},
+    "v2.jokeapi.dev": {"type": "single", "joke": "It works on my machine.", "category": "Programming"},
+    "date.nager.at": [{"date": "2025-01-01", "localName": "New Year's Day", "name": "New Year's Day", "countryCode": "US"}],
+    "numbersapi.com": {"text": "42 is the answer.", "number": 42, "found": True, "type": "trivia"},
+    "api.open-meteo.com": {"latitude": 48.86, "longitude": 2.35, "current_weather": {"temperature": 18.2, "windspeed": 9.4, "weathercode": 1}},
+    "restcountries.com": [{"name": {"common": "Germany"}, "capital": ["Berlin"], "population": 83240525, "region": "Europe"}],
+}
+
+FALLBACK_CODE = 'import json\nprint(json.dumps({"result": "ok"}))'
+
+
+@dataclass
+class FakeConfig:
+    """Seconds each fake waits before answering; LLM latency is spread over the streamed chunks."""
+    llm_latency: float = 1.0
+    embedding_latency: float = 0.05
+    upstream_latency: float = 0.1
+    embedding_dim: int = 256
+
+
+def fake_embedding(text: str, dim: int) -> np.ndarray:
+    """A deterministic bag-of-words vector, so queries still land near the docs that share their words."""
+    vector = np.zeros(dim, dtype=np.float32)
+    for token in re.findall(r"[a-z0-9]+", text.lower()):
+        vector[int(hashlib.md5(token.encode()).hexdigest(), 16) % dim] += 1.0
+    if not vector.any():
+        vector[0] = 1.0
+    return vector
+
+
+def _prompt_text(content) -> str:
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content if isinstance(block, dict))
+
+
+def canned_code(prompt: str) -> str:
+    """The first example script of the first doc in the prompt, i.e. what a good model would write."""
+    match = re.search(r"<api_documentation>\s*(.*?)\s*</api_documentation>", prompt, re.DOTALL)
+    try:
+        docs = json.loads(match.group(1))
+        examples = docs[0]["examples"]
+        if isinstance(examples, str):
+            examples = json.loads(examples)
+        return examples[0]["code"]
+    except Exception:
+        return FALLBACK_CODE
+
+
+class FakeServices:
+    """
+    One local HTTP server standing in for the Anthropic messages API, the
+    OpenAI embeddings API and the upstream APIs (reached through the egress
+    proxy's EGRESS_UPSTREAM_OVERRIDE). Runs uvicorn in a daemon thread.
+    """
+
+    def __init__(self, config: FakeConfig | None = None):
+        self.config = config or FakeConfig()
+        self.calls = {"messages": 0, "embeddings": 0, "embedded_inputs": 0, "upstream": 0}
+        self.tokens = {"input": 0, "output": 0}
+        self.port: int | None = None
+        self._server: uvicorn.Server | None = None
+        self.app = self._build_app()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/v1/messages")
+        async def messages(request: Request):
+            body = await request.json()
+            prompt = "".join(_prompt_text(m["content"]) for m in body["messages"])
+            text = f"<thinking>Use the documented endpoint.</thinking>\n```python\n{canned_code(prompt)}\n```"
+            usage = {"input_tokens": len(prompt) // 4, "output_tokens": len(text) // 4}
+            self.calls["messages"] += 1
+            self.tokens["input"] += usage["input_tokens"]
+            self.tokens["output"] += usage["output_tokens"]
+            message = {
+                "id": "msg_bench", "type": "message", "role": "assistant", "model": body["model"],
+                "stop_reason": "end_turn", "stop_sequence": None,
+            }
+            if not body.get("stream"):
+                await asyncio.sleep(self.config.llm_latency)
+                return {**message, "content": [{"type": "text", "text": text}], "usage": usage}
+            return StreamingResponse(self._stream(message, text, usage), media_type="text/event-stream")
+
+        @app.post("/v1/embeddings")
+        async def embeddings(request: Request):
+            body = await request.json()
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            self.calls["embeddings"] += 1
+            self.calls["embedded_inputs"] += len(inputs)
+            await asyncio.sleep(self.config.embedding_latency)
+            data = []
+            for index, text in enumerate(inputs):
+                vector = fake_embedding(text, self.config.embedding_dim)
+                if body.get("encoding_format") == "base64":
+                    embedding = base64.b64encode(vector.tobytes()).decode()
+                else:
+                    embedding = vector.tolist()
+                data.append({"object": "embedding", "index": index, "embedding": embedding})
+            tokens = sum(len(text.split()) for text in inputs)
+            return {"object": "list", "data": data, "model": body["model"],
+                    "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+        # The warm-up's cheap authenticated calls: Anthropic lists models, OpenAI retrieves one.
+        @app.get("/v1/models")
+        def models(limit: int = 20):
+            model = {"type": "model", "id": "claude-bench", "display_name": "Claude (fake)",
+                     "created_at": "2024-01-01T00:00:00Z"}
+            return {"data": [model][:limit], "has_more": False, "first_id": model["id"], "last_id": model["id"]}
+
+        @app.get("/v1/models/{model_id}")
+        def model(model_id: str):
+            return {"id": model_id, "object": "model", "created": 0, "owned_by": "fake-services"}
+
+        # Registered before the catch-all below, which would otherwise take it.
+        @app.get("/_stats")
+        def stats():
+            return self.stats()
+
+        @app.api_route("/{path:path}", methods=["GET", "POST", "HEAD"])
+        async def upstream(request: Request, path: str):
+            target = request.headers.get("x-egress-url")
+            if target is None:
+                return JSONResponse({"error": "Missing X-Egress-Url header"}, status_code=400)
+            self.calls["upstream"] += 1
+            await asyncio.sleep(self.config.upstream_latency)
+            return JSONResponse(UPSTREAM_PAYLOADS.get(httpx.URL(target).host, {"ok": True}))
+
+        return app
+
+    async def _stream(self, message: dict, text: str, usage: dict):
+        def sse(event: str, data: dict) -> str:
+            return f"event: {event}\ndata: {json.dumps({'type': event, **data})}\n\n"
+
+        chunks = [text[i:i + 40] for i in range(0, len(text), 40)]
+        delay = self.config.llm_latency / (len(chunks) + 1)
+        await asyncio.sleep(delay)
+        yield sse("message_start", {"message": {**message, "content": [], "stop_reason": None,
+                                                "usage": {"input_tokens": usage["input_tokens"], "output_tokens": 1}}})
+        yield sse("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})
+        for chunk in chunks:
+            await asyncio.sleep(delay)
+            yield sse("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": chunk}})
+        yield sse("content_block_stop", {"index": 0})
+        yield sse("message_delta", {"delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                    "usage": {"output_tokens": usage["output_tokens"]}})
+        yield sse("message_stop", {})
+
+    def start(self) -> str:
+        """Starts serving on a free local port and returns the base URL."""
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self._server = uvicorn.Server(uvicorn.Config(self.app, host="127.0.0.1", port=self.port, log_level="warning"))
+        threading.Thread(target=self._server.run, name="fake-services", daemon=True).start()
+        deadline = time.monotonic() + 10
+        while not self._server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Fake services did not start within 10s")
+            time.sleep(0.05)
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.should_exit = True
+
+    def stats(self) -> dict:
+        return {"calls": dict(self.calls), "tokens": dict(self.tokens)}
@@ -1,31 +1,36 @@
 import os
-import glob
-import yaml
 import json
+import time
+import yaml
+import hashlib
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # Load environment variables at the top of the script
 # This ensures they are available before other modules are imported.
 load_dotenv()
 
-from pinecone import Pinecone
-from rag import get_embedding
-from db_models import ApiDoc
+from rag import get_embeddings, RETRIEVAL_BACKEND
+from db_models import ApiDoc, docs_fingerprint
+from local_index import LocalIndex, INDEX_DIR
 
-def main():
-    """
-    One-time script to parse, validate, and embed API documentation,
-    then upsert it into Pinecone.
-    """
-    print("Environment variables loaded.")
+DOCS_DIR = Path(__file__).parent / "api_docs"
+UPSERT_BATCH_SIZE = int(os.environ.get("INDEX_UPSERT_BATCH_SIZE", "100"))
+UPSERT_CONCURRENCY = int(os.environ.get("INDEX_UPSERT_CONCURRENCY", "4"))
+WATCH_INTERVAL = 2.0
 
-    # --- Pinecone Initialization ---
+def init_pinecone():
+    """Connects to the `api-rag` Pinecone index, creating it if needed."""
     try:
+        from pinecone import Pinecone
+
         api_key = os.environ["PINECONE_API_KEY"]
         index_name = "api-rag"
-        
+
         pc = Pinecone(api_key=api_key)
-        
+
         if index_name not in pc.list_indexes().names():
             print(f"Creating Pinecone index '{index_name}'...")
             pc.create_index(
@@ -37,67 +42,245 @@ def main():
             print("Index created successfully.")
         else:
             print(f"Index '{index_name}' already exists.")
-            
-        index = pc.Index(index_name)
-        
+
+        return pc.Index(index_name)
+
     except Exception as e:
         print(f"Error initializing Pinecone: {e}")
-        return
-
-    # --- Document Processing and Upserting ---
-    docs_path = os.path.join(os.path.dirname(__file__), 'api_docs', '*.md')
-    markdown_files = glob.glob(docs_path)
-    
-    if not markdown_files:
-        print(f"No markdown files found in {os.path.dirname(docs_path)}. Nothing to index.")
-        return
-
-    print(f"Found {len(markdown_files)} documents to process.")
-    
-    vectors_to_upsert = []
-    for file_path in markdown_files:
-        vector_id = os.path.basename(file_path).replace('.md', '')
+        return None
+
+def manifest_path(backend: str) -> Path:
+    return INDEX_DIR / f"manifest.{backend}.json"
+
+def load_manifest(backend: str) -> dict[str, str]:
+    """Returns the content hash of every doc last written to this backend, keyed by vector id."""
+    path = manifest_path(backend)
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text(encoding="utf-8"))["docs"]
+
+def save_manifest(backend: str, hashes: dict[str, str]):
+    path = manifest_path(backend)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"docs": hashes}, indent=2, sort_keys=True), encoding="utf-8")
+    os.replace(tmp, path)
+
+def scan_docs(docs_dir: Path = DOCS_DIR) -> dict[str, tuple[str, Path]]:
+    """Maps each vector id (file name without extension) to the sha256 of its file and its path."""
+    return {
+        path.stem: (hashlib.sha256(path.read_bytes()).hexdigest(), path)
+        for path in sorted(docs_dir.glob("*.md"))
+    }
+
+def prepare_vectors(paths: dict[str, Path]) -> dict[str, dict]:
+    """Parses, validates and embeds docs; every embedding comes from one batched request per 512 docs."""
+    parsed = {}
+    for vector_id, file_path in paths.items():
         print(f"  - Processing {vector_id}...")
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                # The first part of the file is YAML front matter
-                yaml_content = f.read().strip('--- \n')
-                doc_data = yaml.safe_load(yaml_content)
+            # The first part of the file is YAML front matter
+            doc_data = yaml.safe_load(file_path.read_text(encoding="utf-8").strip('--- \n'))
 
             # Validate data with Pydantic model
-            api_doc = ApiDoc(**doc_data)
-            
-            # Generate embedding from the description only
-            embedding = get_embedding(api_doc.description)
-            
-            # Prepare the structured metadata
-            metadata = api_doc.model_dump()
-
-            # --- FIX: Serialize the 'examples' list to a JSON string ---
-            if 'examples' in metadata and isinstance(metadata['examples'], list):
-                metadata['examples'] = json.dumps(metadata['examples'])
-
-            vectors_to_upsert.append({
-                "id": vector_id,
-                "values": embedding,
-                "metadata": metadata
-            })
-            print(f"    - Validation and embedding successful.")
-            
+            parsed[vector_id] = ApiDoc(**doc_data)
         except Exception as e:
             print(f"    - Error processing file {file_path}: {e}")
 
-    # --- Batch Upsert to Pinecone ---
-    if vectors_to_upsert:
-        print("\nUpserting vectors to Pinecone...")
+    if not parsed:
+        return {}
+
+    # Generate embeddings from the description only
+    embeddings = get_embeddings([api_doc.description for api_doc in parsed.values()])
+
+    vectors = {}
+    for (vector_id, api_doc), embedding in zip(parsed.items(), embeddings):
+        # Prepare the structured metadata
+        metadata = api_doc.model_dump(exclude={"cache_ttl"})
+
+        # --- FIX: Serialize the 'examples' list to a JSON string ---
+        if 'examples' in metadata and isinstance(metadata['examples'], list):
+            metadata['examples'] = json.dumps(metadata['examples'])
+
+        vectors[vector_id] = {
+            "id": vector_id,
+            "values": embedding.tolist(),
+            "metadata": metadata
+        }
+    print(f"  - Embedded {len(vectors)} documents.")
+    return vectors
+
+def _chunks(items: list, size: int) -> list[list]:
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+def sync_pinecone(index, vectors: list[dict], removed: list[str]) -> set[str]:
+    """
+    Upserts vectors in bounded chunks, several chunks at a time, and deletes
+    the removed ids. Returns the ids whose upsert failed.
+    """
+    def upsert(chunk: list[dict]) -> list[str]:
         try:
-            index.upsert(vectors=vectors_to_upsert)
-            print(f"  - Successfully upserted {len(vectors_to_upsert)} vectors.")
+            index.upsert(vectors=chunk)
+            return []
         except Exception as e:
-            print(f"    - Error upserting vectors: {e}")
-        print("\nIndexing complete!")
-    else:
-        print("No valid vectors were generated. Nothing to upsert.")
+            print(f"    - Error upserting {len(chunk)} vectors: {e}")
+            return [v["id"] for v in chunk]
+
+    failed = set()
+    if vectors:
+        print(f"\nUpserting {len(vectors)} vectors to Pinecone...")
+        with ThreadPoolExecutor(max_workers=UPSERT_CONCURRENCY) as pool:
+            for chunk_failed in pool.map(upsert, _chunks(vectors, UPSERT_BATCH_SIZE)):
+                failed.update(chunk_failed)
+        print(f"  - Successfully upserted {len(vectors) - len(failed)} vectors.")
+
+    if removed:
+        print(f"Deleting {len(removed)} removed vectors from Pinecone...")
+        for chunk in _chunks(removed, UPSERT_BATCH_SIZE):
+            try:
+                index.delete(ids=chunk)
+            except Exception as e:
+                print(f"    - Error deleting vectors: {e}")
+                failed.update(chunk)
+    return failed
+
+def sync_local(existing: LocalIndex | None, vectors: list[dict], removed: list[str]):
+    """Rewrites the local index: unchanged rows are copied over, changed rows replaced, removed rows dropped."""
+    replaced = {v["id"] for v in vectors} | set(removed)
+    ids, rows, metadata = [], [], []
+    if existing is not None:
+        for i, vector_id in enumerate(existing.ids):
+            if vector_id not in replaced:
+                ids.append(vector_id)
+                rows.append(existing.vectors[i])
+                metadata.append(existing.metadata[i])
+    for v in vectors:
+        ids.append(v["id"])
+        rows.append(v["values"])
+        metadata.append(v["metadata"])
+
+    print(f"\nWriting local index to {INDEX_DIR}...")
+    LocalIndex.build(ids=ids, vectors=rows, metadata=metadata).save(INDEX_DIR)
+    print(f"  - Successfully wrote {len(ids)} vectors ({len(vectors)} new or changed, {len(removed)} removed).")
+
+def main(backend: str = RETRIEVAL_BACKEND, full: bool = False):
+    """
+    Parses, validates and embeds API documentation, then brings Pinecone
+    and/or the local vector index up to date. Only docs whose content hash
+    differs from the backend's manifest are re-embedded and written, and
+    vectors of deleted files are removed. `full` ignores the manifests and
+    rewrites every doc. Returns False when embedding or writing failed for
+    some docs; they keep their old manifest hashes, so the next run retries them.
+    """
+    print("Environment variables loaded.")
+
+    targets = ["pinecone", "local"] if backend == "all" else [backend]
+
+    index = None
+    if "pinecone" in targets:
+        index = init_pinecone()
+        if index is None:
+            return False
+
+    # --- Work out what changed since the last run ---
+    docs = scan_docs(DOCS_DIR)
+
+    if not docs:
+        print(f"No markdown files found in {DOCS_DIR}. Nothing to index.")
+        return True
+
+    previous = {target: load_manifest(target) for target in targets}
+    existing = None
+    if "local" in targets and not full:
+        try:
+            existing = LocalIndex.load(INDEX_DIR)
+        except ValueError:
+            # Manifest without an index (or no index yet): rebuild it from scratch.
+            previous["local"] = {}
+
+    changed = {}
+    for target in targets:
+        stale = {} if full else previous[target]
+        changed[target] = [vector_id for vector_id, (digest, _) in docs.items() if stale.get(vector_id) != digest]
+
+    to_embed = sorted(set().union(*changed.values()))
+    print(f"Found {len(docs)} documents, {len(to_embed)} new or changed.")
+
+    complete = True
+    try:
+        vectors = prepare_vectors({vector_id: docs[vector_id][1] for vector_id in to_embed})
+    except Exception as e:
+        # Removals are still applied; the changed docs are retried by the next run.
+        print(f"  - Error generating embeddings: {e}")
+        vectors, complete = {}, False
+
+    # --- Write each backend and record what it now holds ---
+    for target in targets:
+        removed = sorted(set(previous[target]) - set(docs))
+        updates = [vectors[vector_id] for vector_id in changed[target] if vector_id in vectors]
+        if not updates and not removed:
+            if complete:
+                print(f"\n{target}: already up to date.")
+            continue
+
+        failed = set()
+        if target == "pinecone":
+            failed = sync_pinecone(index, updates, removed)
+        else:
+            sync_local(existing, updates, removed)
+
+        # Docs that failed to parse or write keep their old hash, so the next run retries them.
+        hashes = {}
+        for vector_id, (digest, _) in docs.items():
+            if vector_id in vectors and vector_id not in failed:
+                hashes[vector_id] = digest
+            elif vector_id in previous[target]:
+                hashes[vector_id] = previous[target][vector_id]
+        hashes.update({vector_id: previous[target][vector_id] for vector_id in removed if vector_id in failed})
+        save_manifest(target, hashes)
+        complete = complete and not failed
+
+    print("\nIndexing complete!" if complete else "\nIndexing incomplete; failed docs are retried on the next run.")
+    return complete
+
+def watch(backend: str = RETRIEVAL_BACKEND, full: bool = False, interval: float = WATCH_INTERVAL):
+    """
+    Re-runs the incremental indexer whenever a file in api_docs/ changes.
+    A server using the local backend picks up the rewritten index on its
+    next retrieval (see rag.get_backend); Pinecone serves upserts directly.
+    """
+    print(f"Watching {DOCS_DIR} for changes (Ctrl+C to stop)...")
+    fingerprint = None
+    try:
+        while True:
+            current = docs_fingerprint(DOCS_DIR)
+            if current != fingerprint:
+                if fingerprint is not None:
+                    print("\nChange detected in api_docs/, re-indexing...")
+                try:
+                    complete = main(backend=backend, full=full and fingerprint is None)
+                except Exception as e:
+                    print(f"Error re-indexing: {e}")
+                    complete = False
+                # An incomplete run leaves the fingerprint alone, so the next pass retries it.
+                if complete:
+                    fingerprint = current
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Embed api_docs/*.md and write them to the vector store.")
+    parser.add_argument(
+        "--backend",
+        choices=["pinecone", "local", "all"],
+        default=RETRIEVAL_BACKEND,
+        help="Where to write the vectors (defaults to RETRIEVAL_BACKEND).",
+    )
+    parser.add_argument("--full", action="store_true", help="Re-embed and rewrite every doc, ignoring the manifest.")
+    parser.add_argument("--watch", action="store_true", help="Keep running and re-index whenever api_docs/ changes.")
+    args = parser.parse_args()
+    if args.watch:
+        watch(backend=args.backend, full=args.full)
+    else:
+        main(backend=args.backend, full=args.full)
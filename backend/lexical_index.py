@@ -0,0 +1,88 @@
+import re
+import math
+from collections import Counter
+from pathlib import Path
+from db_models import ApiDoc, STOPWORDS, load_api_docs
+
+DOCS_DIR = Path(__file__).parent / "api_docs"
+
+# Okapi BM25 parameters: term-frequency saturation and document-length normalization.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased alphanumeric terms without filler words; a trailing plural "s" is dropped."""
+    terms = []
+    for term in re.findall(r"[a-z0-9]+", text.lower()):
+        if term in STOPWORDS:
+            continue
+        if len(term) > 3 and term.endswith("s") and not term.endswith("ss"):
+            term = term[:-1]
+        terms.append(term)
+    return terms
+
+
+def doc_text(doc: ApiDoc) -> str:
+    """The fields a query is matched against: name, description, summary and example queries."""
+    parts = [doc.name, doc.description, doc.documentation_summary or ""]
+    parts += [example.user_query for example in doc.examples]
+    return "\n".join(parts)
+
+
+class LexicalIndex:
+    """
+    BM25 over the api_docs corpus. Term statistics (postings with term
+    frequencies, IDF, document lengths) are computed once when the index is
+    built, so scoring a query only walks the postings of its own terms.
+    Matches have the same shape as the vector indexes' (`id`, `score`,
+    `metadata`).
+    """
+
+    def __init__(self, ids: list[str], texts: list[str], metadata: list[dict]):
+        if len(ids) != len(texts) or len(ids) != len(metadata):
+            raise ValueError("ids, texts and metadata must have the same length.")
+        self.ids = ids
+        self.metadata = metadata
+        tokenized = [tokenize(text) for text in texts]
+        self.lengths = [len(terms) for terms in tokenized]
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        # term -> [(doc position, term frequency)]
+        self.postings: dict[str, list[tuple[int, int]]] = {}
+        for position, terms in enumerate(tokenized):
+            for term, frequency in Counter(terms).items():
+                self.postings.setdefault(term, []).append((position, frequency))
+        n = len(ids)
+        self.idf = {
+            term: math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+
+    @classmethod
+    def from_docs(cls, docs_dir: Path = DOCS_DIR) -> "LexicalIndex":
+        docs = load_api_docs(docs_dir)
+        return cls(
+            ids=list(docs),
+            texts=[doc_text(doc) for doc in docs.values()],
+            metadata=[doc.model_dump(exclude={"cache_ttl"}) for doc in docs.values()],
+        )
+
+    def scores(self, query: str) -> dict[int, float]:
+        """BM25 score of every doc sharing at least one term with the query, by position."""
+        scores: dict[int, float] = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for position, frequency in self.postings[term]:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[position] / self.avg_length)
+                scores[position] = scores.get(position, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return scores
+
+    def query(self, query: str, top_k: int = 2) -> list[dict]:
+        """Returns the top_k docs by BM25 score, best first. Docs scoring 0 are omitted."""
+        ranked = sorted(self.scores(query).items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [
+            {"id": self.ids[position], "score": score, "metadata": self.metadata[position]}
+            for position, score in ranked
+        ]
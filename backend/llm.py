@@ -1,16 +1,56 @@
-import anthropic
 import os
 import re
 import json
+import logging
+import threading
+from dataclasses import dataclass
+import metrics
+import admission
+import background
+
+log = logging.getLogger(__name__)
+
+MODEL = "claude-3-5-sonnet-20240620"
+
+# Rough size budget (in tokens, ~4 characters each) for the API docs in a prompt.
+# Lower-ranked docs lose their extra examples first, then are dropped.
+DOCS_TOKEN_BUDGET = int(os.environ.get("PROMPT_DOCS_TOKEN_BUDGET", "1500"))
+# Characters of script output kept when asking Claude to fix a failed script.
+MAX_ERROR_CHARS = 2000
+
+# The clients are built on first use rather than at import: importing the
+# SDK is a large share of the app's cold start. The request path uses the
+# async client; the sync one is kept for scripts that call the SDK directly.
+_clients = None  # (sync, async) once built
+_clients_lock = threading.Lock()
+
+
+def _get_clients():
+    """Builds both clients on first call; they are None if CLAUDE_API_KEY is not set."""
+    global _clients
+    if _clients is None:
+        with _clients_lock:
+            if _clients is None:
+                api_key = os.environ.get("CLAUDE_API_KEY")
+                if api_key:
+                    import anthropic
+                    _clients = (anthropic.Anthropic(api_key=api_key), anthropic.AsyncAnthropic(api_key=api_key))
+                else:
+                    # The app still starts; LLM calls fail until the key is set.
+                    log.warning("CLAUDE_API_KEY environment variable not set.")
+                    _clients = (None, None)
+    return _clients
+
+
+def get_client():
+    """The sync Anthropic client, or None if CLAUDE_API_KEY is not set."""
+    return _get_clients()[0]
+
+
+def get_async_client():
+    """The async Anthropic client, or None if CLAUDE_API_KEY is not set."""
+    return _get_clients()[1]
 
-# Initialize the client from the environment variable
-try:
-    client = anthropic.Anthropic(api_key=os.environ["CLAUDE_API_KEY"])
-except KeyError:
-    # This allows the app to start even if the key is not set,
-    # but it will fail when an LLM call is made.
-    client = None 
-    print("Warning: CLAUDE_API_KEY environment variable not set.")
 
 # Few-shot examples to guide the LLM in generating correct code.
 # This helps it understand the expected output format.
@@ -33,9 +73,9 @@ example: |
 The user wants a joke. The JokeAPI is perfect for this. The documentation shows a simple GET request to a URL. I will write Python code to perform this GET request using the httpx library and print the JSON response. The user's query is simple and doesn't require any parameters.
 </thinking>
 <code>
-import httpx, json
+import httpx, json, sys
 
-print("Fetching a random joke...")
+print("Fetching a random joke...", file=sys.stderr)
 try:
     resp = httpx.get("https://v2.jokeapi.dev/joke/Any", timeout=5)
     resp.raise_for_status()
@@ -64,9 +104,9 @@ example: |
 The user wants public holidays for a specific country (Canada) and year (2025). The Nager.Date API is designed for this. I need to extract the year '2025' and the country code 'CA' from the user's query. The documentation provides the base URL structure. I will construct the full URL, make a GET request, and print the JSON response.
 </thinking>
 <code>
-import httpx, json
+import httpx, json, sys
 
-print("Fetching public holidays for CA in 2025...")
+print("Fetching public holidays for CA in 2025...", file=sys.stderr)
 try:
     year = "2025"
     country_code = "CA"
@@ -94,7 +134,18 @@ You are an expert Python programmer. Your primary task is to write a single, sel
 First, think step-by-step about the user's request and the provided documentation inside `<thinking>` tags. Then, provide the complete, runnable Python script as your final answer.
 """
 
-def _extract_code(response_text: str) -> str:
+# The system prompt and few-shot examples never change, so they form a stable
+# prefix that Anthropic caches between calls (cache_control marks its end).
+SYSTEM_BLOCKS = [
+    {"type": "text", "text": SYSTEM_PROMPT.strip()},
+    {
+        "type": "text",
+        "text": f"Examples of good answers:\n{FEW_SHOT_EXAMPLES.strip()}",
+        "cache_control": {"type": "ephemeral"},
+    },
+]
+
+def extract_code(response_text: str) -> str:
     """
     Robustly extracts Python code from the LLM's response.
     It removes <thinking> blocks and markdown fences.
@@ -103,7 +154,11 @@ def _extract_code(response_text: str) -> str:
     response_text = re.sub(r"<thinking>.*?</thinking>", "", response_text, flags=re.DOTALL)
     
     # Then, look for a code block. If not found, assume the whole response is code.
-    match = re.search(r"```(?:python)?\n(.*)```", response_text, re.DOTALL)
+    match = (
+        re.search(r"```(?:python)?\n(.*)```", response_text, re.DOTALL)
+        # The few-shot examples wrap their answers in <code> tags
+        or re.search(r"<code>\n?(.*?)</code>", response_text, re.DOTALL)
+    )
     if match:
         code = match.group(1)
     else:
@@ -111,42 +166,93 @@ def _extract_code(response_text: str) -> str:
 
     return code.strip()
 
-def generate_code(user_query: str, retrieved_docs: list[dict]) -> str:
-    """Generates Python code based on the user query and retrieved structured API docs."""
-    if not client:
-        raise ValueError("Anthropic client is not initialized. Please set the CLAUDE_API_KEY.")
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4
 
-    docs_json_str = json.dumps(retrieved_docs, indent=2)
-    
-    prompt = f"""<user_query>
-{user_query}
-</user_query>
-<api_documentation>
-{docs_json_str}
-</api_documentation>
-"""
+def _compact_docs(retrieved_docs: list[dict], budget: int = DOCS_TOKEN_BUDGET) -> str:
+    """
+    Serializes the docs as compact JSON (no indentation, empty fields dropped)
+    within `budget` tokens. Docs stay in retrieval order; the top doc is always
+    kept with at least one example.
+    """
+    docs = [{k: v for k, v in doc.items() if v not in (None, "", [])} for doc in retrieved_docs]
 
-    message = client.messages.create(
-        model="claude-3-5-sonnet-20240620",
-        max_tokens=2048,
-        temperature=0.0,
-        system=SYSTEM_PROMPT,
-        messages=[{"role": "user", "content": prompt}]
-    ).content[0].text
-    
-    return _extract_code(message)
+    def serialize() -> str:
+        return json.dumps(docs, separators=(",", ":"), ensure_ascii=False)
 
+    text = serialize()
+    while estimate_tokens(text) > budget:
+        # Trim from the least relevant doc: extra examples, then all examples, then the doc itself.
+        doc = next((d for d in reversed(docs) if len(d.get("examples", [])) > 1), None)
+        if doc is not None:
+            doc["examples"] = doc["examples"][:-1]
+        elif len(docs) > 1 and "examples" in docs[-1]:
+            del docs[-1]["examples"]
+        elif len(docs) > 1:
+            docs.pop()
+        else:
+            break
+        text = serialize()
+    return text
 
-def generate_code_with_retry(old_code: str, error: str, user_query: str, retrieved_docs: list[dict]) -> str:
-    """Attempts to fix broken code given the error it produced and the original context."""
-    if not client:
-        raise ValueError("Anthropic client is not initialized. Please set the CLAUDE_API_KEY.")
+def trim_error(error: str, max_chars: int = MAX_ERROR_CHARS) -> str:
+    """
+    Shortens a failed run's output for the retry prompt: traceback frames from
+    installed libraries are collapsed (the script's own frames and the last
+    frame are kept), and what remains is cut to `max_chars` around the middle.
+    """
+    lines = error.splitlines()
+    kept, skipped = [], 0
+    frame_starts = [i for i, line in enumerate(lines) if line.startswith('  File "')]
+    last_frame = frame_starts[-1] if frame_starts else -1
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.startswith('  File "') and i != last_frame and ("site-packages" in line or "/lib/python" in line):
+            # A frame is its File line plus the indented source line(s) below it.
+            i += 1
+            while i < len(lines) and lines[i].startswith("    "):
+                i += 1
+            skipped += 1
+            continue
+        if skipped:
+            kept.append(f"  ... {skipped} library frame(s) omitted ...")
+            skipped = 0
+        kept.append(line)
+        i += 1
+    text = "\n".join(kept)
+    if len(text) > max_chars:
+        half = max_chars // 2
+        text = f"{text[:half]}\n... {len(text) - max_chars} characters omitted ...\n{text[-half:]}"
+    return text
 
-    print(f"--- Code failed. Retrying with error: {error} ---")
-    
-    docs_json_str = json.dumps(retrieved_docs, indent=2)
-    
-    prompt = f"""
+@dataclass
+class Prompt:
+    """The user-message content blocks for one call, with token estimates for the metrics."""
+    content: list[dict]
+    tokens: int
+    uncompacted_tokens: int
+
+def _docs_block(retrieved_docs: list[dict]) -> dict:
+    # Second cache breakpoint: a retry (or another query over the same docs)
+    # reuses everything up to and including the docs.
+    return {
+        "type": "text",
+        "text": f"<api_documentation>\n{_compact_docs(retrieved_docs)}\n</api_documentation>",
+        "cache_control": {"type": "ephemeral"},
+    }
+
+def _build_prompt(user_query: str, retrieved_docs: list[dict]) -> Prompt:
+    content = [
+        _docs_block(retrieved_docs),
+        {"type": "text", "text": f"<user_query>\n{user_query}\n</user_query>"},
+    ]
+    uncompacted = estimate_tokens(json.dumps(retrieved_docs, indent=2) + user_query)
+    return Prompt(content, sum(estimate_tokens(block["text"]) for block in content), uncompacted)
+
+
+def _build_retry_prompt(old_code: str, error: str, user_query: str, retrieved_docs: list[dict]) -> Prompt:
+    text = f"""
 The previous attempt to write a Python script failed. Here is all the context to fix it.
 
 **Original User Query:**
@@ -154,11 +260,6 @@ The previous attempt to write a Python script failed. Here is all the context to
 {user_query}
 </user_query>
 
-**API Documentation Provided:**
-<api_documentation>
-{docs_json_str}
-</api_documentation>
-
 **The Code That Failed:**
 <original_code>
 {old_code}
@@ -166,19 +267,90 @@ The previous attempt to write a Python script failed. Here is all the context to
 
 **The Error It Produced:**
 <error_traceback>
-{error}
+{trim_error(error)}
 </error_traceback>
 
-Please analyze the original query, the documentation, the failed code, and the error. Provide the fully corrected, complete Python script.
+Please analyze the original query, the documentation above, the failed code, and the error. Provide the fully corrected, complete Python script.
 Think step-by-step about what went wrong and how to fix it inside the <thinking> tags, then provide ONLY the corrected Python code.
 """
-    
-    message = client.messages.create(
-        model="claude-3-5-sonnet-20240620",
-        max_tokens=2048,
-        temperature=0.1,
-        system=SYSTEM_PROMPT,
-        messages=[{"role": "user", "content": prompt}]
-    ).content[0].text
-
-    return _extract_code(message) 
\ No newline at end of file
+    content = [_docs_block(retrieved_docs), {"type": "text", "text": text}]
+    uncompacted = estimate_tokens(json.dumps(retrieved_docs, indent=2) + user_query + old_code + error) + 150
+    return Prompt(content, sum(estimate_tokens(block["text"]) for block in content), uncompacted)
+
+
+def _message_params(prompt: Prompt, temperature: float) -> dict:
+    return {
+        "model": MODEL,
+        "max_tokens": 2048,
+        "temperature": temperature,
+        "system": SYSTEM_BLOCKS,
+        "messages": [{"role": "user", "content": prompt.content}],
+    }
+
+
+def _record_prompt(call: str, prompt: Prompt, details: dict):
+    metrics.record_prompt(call, prompt.uncompacted_tokens, prompt.tokens)
+    details["prompt_tokens_est"] = prompt.tokens
+    details["uncompacted_tokens_est"] = prompt.uncompacted_tokens
+
+
+def _require_client():
+    async_client = get_async_client()
+    if not async_client:
+        raise ValueError("Anthropic client is not initialized. Please set the CLAUDE_API_KEY.")
+    return async_client
+
+
+async def _complete(call: str, prompt: Prompt, temperature: float) -> str:
+    """Sends the prompt under an LLM admission slot and returns the code in Claude's answer."""
+    async_client = _require_client()
+    async with admission.LLM.hold_async():
+        with metrics.span(f"llm_{call}") as details:
+            _record_prompt(call, prompt, details)
+            response = await async_client.messages.create(**_message_params(prompt, temperature))
+            metrics.record_usage(call, getattr(response, "usage", None), details)
+    return extract_code(response.content[0].text)
+
+
+async def _stream(call: str, prompt: Prompt, temperature: float):
+    """Streaming variant of `_complete`: yields the raw response text as Claude produces it."""
+    async_client = _require_client()
+    async with admission.LLM.hold_async():
+        with metrics.span(f"llm_{call}") as details:
+            _record_prompt(call, prompt, details)
+            async with async_client.messages.stream(**_message_params(prompt, temperature)) as stream:
+                async for text in stream.text_stream:
+                    yield text
+                final = await stream.get_final_message()
+            metrics.record_usage(call, getattr(final, "usage", None), details)
+
+
+async def generate_code_async(user_query: str, retrieved_docs: list[dict], temperature: float = 0.0) -> str:
+    """Generates Python code based on the user query and retrieved structured API docs."""
+    return await _complete("generate", _build_prompt(user_query, retrieved_docs), temperature)
+
+
+async def generate_code_with_retry_async(old_code: str, error: str, user_query: str, retrieved_docs: list[dict]) -> str:
+    """Attempts to fix broken code given the error it produced and the original context."""
+    log.info("Code failed. Retrying with error: %s", error)
+    return await _complete("retry", _build_retry_prompt(old_code, error, user_query, retrieved_docs), 0.1)
+
+
+def generate_code(user_query: str, retrieved_docs: list[dict], temperature: float = 0.0) -> str:
+    """Blocking wrapper around `generate_code_async`, for scripts."""
+    return background.run(generate_code_async(user_query, retrieved_docs, temperature))
+
+
+def generate_code_with_retry(old_code: str, error: str, user_query: str, retrieved_docs: list[dict]) -> str:
+    """Blocking wrapper around `generate_code_with_retry_async`, for scripts."""
+    return background.run(generate_code_with_retry_async(old_code, error, user_query, retrieved_docs))
+
+
+def stream_code_async(user_query: str, retrieved_docs: list[dict]):
+    """Streams the raw response text of `generate_code_async` as Claude produces it."""
+    return _stream("generate", _build_prompt(user_query, retrieved_docs), 0.0)
+
+
+def stream_code_with_retry_async(old_code: str, error: str, user_query: str, retrieved_docs: list[dict]):
+    """Streams the raw response text of `generate_code_with_retry_async`."""
+    return _stream("retry", _build_retry_prompt(old_code, error, user_query, retrieved_docs), 0.1)
@@ -0,0 +1,88 @@
+import os
+import json
+from pathlib import Path
+import numpy as np
+
+INDEX_DIR = Path(os.environ.get("LOCAL_INDEX_DIR", Path(__file__).parent / ".index"))
+VECTORS_FILE = "vectors.npy"
+METADATA_FILE = "metadata.json"
+
+
+class LocalIndex:
+    """
+    A small in-process vector index for the api_docs corpus.
+    Vectors are stored as one contiguous, L2-normalized float32 matrix so
+    cosine similarity for a batch of queries is a single matmul. Matches are
+    returned in the same shape as Pinecone's (`id`, `score`, `metadata`).
+    """
+
+    def __init__(self, ids: list[str], vectors: np.ndarray, metadata: list[dict]):
+        if len(ids) != len(vectors) or len(ids) != len(metadata):
+            raise ValueError("ids, vectors and metadata must have the same length.")
+        self.ids = ids
+        self.vectors = vectors
+        self.metadata = metadata
+
+    @classmethod
+    def build(cls, ids: list[str], vectors, metadata: list[dict]) -> "LocalIndex":
+        matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+        return cls(list(ids), _normalize(matrix), list(metadata))
+
+    def save(self, path: Path = INDEX_DIR):
+        """Writes the matrix and metadata side by side, replacing any previous index atomically."""
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        tmp_vectors = path / f"{VECTORS_FILE}.tmp"
+        tmp_metadata = path / f"{METADATA_FILE}.tmp"
+        with open(tmp_vectors, "wb") as f:
+            np.save(f, self.vectors)
+        tmp_metadata.write_text(json.dumps({"ids": self.ids, "metadata": self.metadata}), encoding="utf-8")
+        os.replace(tmp_vectors, path / VECTORS_FILE)
+        os.replace(tmp_metadata, path / METADATA_FILE)
+
+    @classmethod
+    def load(cls, path: Path = INDEX_DIR) -> "LocalIndex":
+        path = Path(path)
+        if not (path / VECTORS_FILE).exists():
+            raise ValueError(f"Local index not found at {path}. Run index_docs.py first.")
+        vectors = np.load(path / VECTORS_FILE, mmap_mode="r")
+        stored = json.loads((path / METADATA_FILE).read_text(encoding="utf-8"))
+        return cls(stored["ids"], vectors, stored["metadata"])
+
+    @staticmethod
+    def version(path: Path = INDEX_DIR) -> int | None:
+        """Changes whenever `save` rewrites the index (metadata is replaced last), None if there is none."""
+        try:
+            return (Path(path) / METADATA_FILE).stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def query(self, vector, top_k: int = 2) -> list[dict]:
+        return self.query_batch([vector], top_k)[0]
+
+    def query_batch(self, vectors, top_k: int = 2) -> list[list[dict]]:
+        """Returns the top_k matches for each query vector, best first."""
+        if len(self.ids) == 0:
+            return [[] for _ in vectors]
+        queries = _normalize(np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1))
+        scores = queries @ self.vectors.T
+        k = min(top_k, scores.shape[1])
+        # argpartition finds the top k in O(n); only those k are then sorted.
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+
+        results = []
+        for row, indices in enumerate(top):
+            results.append([
+                {"id": self.ids[i], "score": float(scores[row, i]), "metadata": self.metadata[i]}
+                for i in indices
+            ])
+        return results
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
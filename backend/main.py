@@ -1,17 +1,45 @@
+import time
+
+# Measured against IMPORT_TIME_BUDGET once the app is built (see warmup.py).
+_import_started = time.perf_counter()
+
 from dotenv import load_dotenv
 
 # Load environment variables from .env file at startup
 # This MUST be done before importing any other application modules that need them.
 load_dotenv()
 
-from fastapi import FastAPI
+import os
+import logging
+
+# Application logs go through the standard logging module; LOG_LEVEL=DEBUG
+# also logs every generated script.
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from router import router
+import admission
+import warmup
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Connect to the providers, load the indexes, compile the templates and
+    # spawn the sandbox pool before the first request instead of during it.
+    await warmup.start()
+    yield
+    await warmup.stop()
 
 app = FastAPI(
     title="Universal API Demo",
     description="An agentic API that writes and executes code to call other APIs on the fly.",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
 # Configure CORS to allow frontend requests
@@ -25,6 +53,17 @@ app.add_middleware(
 
 app.include_router(router)
 
+@app.exception_handler(admission.Overloaded)
+async def overloaded(request: Request, exc: admission.Overloaded):
+    # 429 when this client has too much queued, 503 when the server as a whole is saturated.
+    return JSONResponse(
+        {"error": str(exc), "retry_after": exc.retry_after},
+        status_code=exc.status,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
 @app.get("/", tags=["Root"])
 def read_root():
-    return {"message": "Welcome to the Universal API Demo. Send POST requests to /chat."} 
\ No newline at end of file
+    return {"message": "Welcome to the Universal API Demo. Send POST requests to /chat."}
+
+warmup.record_import(time.perf_counter() - _import_started)
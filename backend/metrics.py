@@ -0,0 +1,223 @@
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets; +Inf is implied.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: tuple[str, ...], extra: dict | None = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return super().render() + [f"{self.name}{self._labels(key)} {value}" for key, value in sorted(values.items())]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return super().render() + [f"{self.name}{self._labels(key)} {value}" for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: [count per bucket (+Inf last), sum]
+        self._values: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = super().render()
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{self._labels(key, {'le': le})} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram("chat_request_seconds", "End-to-end latency of chat requests.", ("tier",))
+STAGE_SECONDS = Histogram("chat_stage_seconds", "Latency of each pipeline stage.", ("stage",))
+REQUESTS = Counter("chat_requests_total", "Chat requests by the tier that answered them.", ("tier",))
+RETRIES = Counter("chat_retries_total", "Code regenerations after a failed execution.")
+LLM_TOKENS = Counter("llm_tokens_total", "Anthropic tokens used, from the response usage field.", ("call", "kind"))
+PROMPT_TOKENS = Counter(
+    "llm_prompt_tokens_estimated_total", "Estimated per-request prompt tokens, compacted vs. the old layout.", ("call", "layout")
+)
+COALESCED = Counter(
+    "chat_coalesced_requests_total",
+    "Chat requests answered by an identical request's pipeline run, while in flight or just after.", ("shared",)
+)
+ERROR_TRIAGE = Counter(
+    "chat_error_triage_total", "Failed script runs by class: transient, mechanical or logical.", ("kind",)
+)
+LLM_RETRIES_AVOIDED = Counter(
+    "chat_llm_retries_avoided_total", "Failed runs that succeeded after a local re-run or repair, by class.", ("kind",)
+)
+RETRIEVALS = Counter(
+    "retrievals_total", "Retrievals by path: BM25 alone (lexical), BM25 fused with vectors (hybrid) or vector.", ("path",)
+)
+QUEUE_WAIT_SECONDS = Histogram("admission_queue_wait_seconds", "Time spent waiting for a slot, per limited stage.", ("stage",))
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total", "Work turned away because a stage's queue was full or the wait ran out.", ("stage", "status")
+)
+RATE_LIMITED = Counter("provider_rate_limited_total", "Rate-limit or overloaded errors returned by a provider.", ("stage",))
+CONCURRENCY_LIMIT = Gauge("admission_concurrency_limit", "Current concurrency limit per stage (adapts to rate limits).", ("stage",))
+IN_FLIGHT = Gauge("admission_in_flight", "Work currently holding a slot, per stage.", ("stage",))
+QUEUED = Gauge("admission_queued", "Work currently waiting for a slot, per stage.", ("stage",))
+SANDBOX_SPAWN_SECONDS = Histogram(
+    "sandbox_spawn_seconds", "Time to start a sandbox interpreter (pool worker or cold process).", ("mode",)
+)
+
+REGISTRY = [
+    REQUEST_SECONDS, STAGE_SECONDS, REQUESTS, RETRIES, LLM_TOKENS, PROMPT_TOKENS, COALESCED, RETRIEVALS,
+    ERROR_TRIAGE, LLM_RETRIES_AVOIDED,
+    QUEUE_WAIT_SECONDS, ADMISSION_REJECTED, RATE_LIMITED, CONCURRENCY_LIMIT, IN_FLIGHT, QUEUED,
+    SANDBOX_SPAWN_SECONDS,
+]
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+class Timings:
+    """The stages of one request, in the order they finished, for the optional response breakdown."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: list[dict] = []
+
+    def add(self, stage: str, seconds: float, **details):
+        self.stages.append({"stage": stage, "ms": round(seconds * 1000, 2), **details})
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def summary(self) -> dict:
+        return {"total_ms": round(self.elapsed() * 1000, 2), "stages": self.stages}
+
+
+# The breakdown of the request running in the current context. Each request
+# is handled in its own task (or thread), and the tasks and threads it starts
+# inherit the context, so stages recorded anywhere below it land here.
+_current: contextvars.ContextVar[Timings | None] = contextvars.ContextVar("timings", default=None)
+
+
+def start_request() -> Timings:
+    """Begins a new breakdown for the current context and returns it."""
+    timings = Timings()
+    _current.set(timings)
+    return timings
+
+
+def record(stage: str, seconds: float, **details):
+    """Adds a finished stage to the stage histogram and to the current request's breakdown."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _current.get()
+    if timings is not None:
+        timings.add(stage, seconds, **details)
+
+
+@contextmanager
+def span(stage: str, **details):
+    """Times the block as `stage`. Yields a dict the block can add details (e.g. token counts) to."""
+    start = time.perf_counter()
+    try:
+        yield details
+    finally:
+        record(stage, time.perf_counter() - start, **details)
+
+
+def record_usage(call: str, usage, details: dict | None = None):
+    """Counts the input/output and prompt-cache tokens of an Anthropic response, if it reports usage."""
+    if usage is None:
+        return
+    for kind in ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"):
+        count = getattr(usage, kind, None) or 0
+        LLM_TOKENS.inc(count, call=call, kind=kind.removesuffix("_tokens"))
+        if details is not None and count:
+            details[kind] = count
+
+
+def record_prompt(call: str, uncompacted_tokens: int, tokens: int):
+    """Estimated prompt size with and without compaction, excluding the cached system prefix."""
+    PROMPT_TOKENS.inc(uncompacted_tokens, call=call, layout="uncompacted")
+    PROMPT_TOKENS.inc(tokens, call=call, layout="compacted")
+
+
+def record_request(tier: str, seconds: float):
+    REQUESTS.inc(tier=tier)
+    REQUEST_SECONDS.observe(seconds, tier=tier)
+
@@ -1,60 +1,418 @@
 import os
-import openai
 import json
-from pinecone import Pinecone
-
-# Initialize clients from environment variables
-try:
-    pc = Pinecone(api_key=os.environ["PINECONE_API_KEY"])
-    openai_client = openai.OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-    pinecone_index = pc.Index("api-rag")
-except Exception as e:
-    pc = None
-    openai_client = None
-    pinecone_index = None
-    print(f"Warning: RAG system not initialized. Error: {e}")
-
-def get_embedding(text: str, model: str = "text-embedding-3-small") -> list[float]:
-    """Generates an embedding for the given text using OpenAI's API."""
+import asyncio
+import logging
+import threading
+import numpy as np
+import embedding_cache
+import metrics
+import admission
+from db_models import current_docs_fingerprint
+from local_index import LocalIndex
+from lexical_index import LexicalIndex, DOCS_DIR
+
+log = logging.getLogger(__name__)
+
+# Maximum inputs per embeddings request when embedding in batches.
+EMBEDDING_BATCH_SIZE = 512
+
+# Which vector store `retrieve` queries: "pinecone" (default) or "local",
+# the in-process NumPy index that `index_docs.py` writes to disk.
+RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND", "pinecone")
+
+# The OpenAI clients and the Pinecone index are built on first use rather than
+# at import, so the SDK imports don't slow down starting the app (or index_docs.py).
+_openai_clients = None  # (sync, async) once built
+_openai_lock = threading.Lock()
+
+
+def _get_openai_clients():
+    global _openai_clients
+    if _openai_clients is None:
+        with _openai_lock:
+            if _openai_clients is None:
+                try:
+                    import openai
+                    _openai_clients = (
+                        openai.OpenAI(api_key=os.environ["OPENAI_API_KEY"]),
+                        openai.AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"]),
+                    )
+                except Exception as e:
+                    log.warning("OpenAI client not initialized. Error: %s", e)
+                    _openai_clients = (None, None)
+    return _openai_clients
+
+
+def get_openai_client():
+    """The sync OpenAI client, or None if it couldn't be created (e.g. OPENAI_API_KEY is not set)."""
+    return _get_openai_clients()[0]
+
+
+def get_async_openai_client():
+    """The async OpenAI client, or None if it couldn't be created."""
+    return _get_openai_clients()[1]
+
+
+# Lexical (BM25) retrieval over api_docs/. When the best BM25 match scores at
+# least LEXICAL_MIN_SCORE and LEXICAL_MARGIN times the runner-up, it is used
+# on its own and the query is never embedded; otherwise BM25 and vector
+# matches are merged with reciprocal rank fusion.
+LEXICAL_RETRIEVAL_ENABLED = os.environ.get("LEXICAL_RETRIEVAL_ENABLED", "1") != "0"
+LEXICAL_MIN_SCORE = float(os.environ.get("LEXICAL_MIN_SCORE", "3.0"))
+LEXICAL_MARGIN = float(os.environ.get("LEXICAL_MARGIN", "2.0"))
+# Rank offset of reciprocal rank fusion, and how many matches of each kind are fused.
+RRF_K = 60
+FUSION_CANDIDATES = 5
+
+
+class PineconeBackend:
+    """Retrieval backend that queries the hosted `api-rag` Pinecone index."""
+
+    def __init__(self):
+        self.index = None
+        try:
+            from pinecone import Pinecone
+            pc = Pinecone(api_key=os.environ["PINECONE_API_KEY"])
+            self.index = pc.Index("api-rag")
+        except Exception as e:
+            log.warning("RAG system not initialized. Error: %s", e)
+
+    def query(self, vector, top_k: int = 2) -> list[dict]:
+        if not self.index:
+            raise ValueError("Pinecone index not initialized. Please check your API keys and environment.")
+        results = self.index.query(vector=np.asarray(vector).tolist(), top_k=top_k, include_metadata=True)
+        return results['matches']
+
+    def query_batch(self, vectors, top_k: int = 2) -> list[list[dict]]:
+        return [self.query(vector, top_k) for vector in vectors]
+
+    async def query_async(self, vector, top_k: int = 2) -> list[dict]:
+        # The Pinecone client is blocking, so keep it off the event loop.
+        return await asyncio.to_thread(self.query, vector, top_k)
+
+    async def query_batch_async(self, vectors, top_k: int = 2) -> list[list[dict]]:
+        # Pinecone has no multi-vector query, so issue the queries concurrently.
+        return await asyncio.gather(*(self.query_async(vector, top_k) for vector in vectors))
+
+
+_backend = None
+_backend_version = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Returns the configured retrieval backend, loading the local index on first
+    use and reloading it whenever index_docs.py has rewritten it since.
+    """
+    global _backend, _backend_version
+    with _backend_lock:
+        if RETRIEVAL_BACKEND == "local":
+            version = LocalIndex.version()
+            if _backend is None or version != _backend_version:
+                try:
+                    index = LocalIndex.load()
+                except ValueError as e:
+                    # Keep serving the index we have if a rewrite is still in progress.
+                    if _backend is None:
+                        raise
+                    log.warning("Could not reload local index, keeping the previous one. Error: %s", e)
+                else:
+                    if _backend is not None:
+                        log.info("Reloaded local index (%d docs).", len(index.ids))
+                    _backend, _backend_version = index, version
+        elif _backend is None:
+            if RETRIEVAL_BACKEND == "pinecone":
+                _backend = PineconeBackend()
+            else:
+                raise ValueError(f"Unknown RETRIEVAL_BACKEND '{RETRIEVAL_BACKEND}'. Use 'pinecone' or 'local'.")
+    return _backend
+
+
+_lexical_index = None
+_lexical_fingerprint = None
+_lexical_lock = threading.Lock()
+
+
+def get_lexical_index() -> LexicalIndex:
+    """Returns the BM25 index of api_docs/, rebuilding it whenever a doc file changes."""
+    global _lexical_index, _lexical_fingerprint
+    with _lexical_lock:
+        fingerprint = current_docs_fingerprint()
+        if _lexical_index is None or fingerprint != _lexical_fingerprint:
+            if _lexical_index is not None:
+                log.info("api_docs changed; rebuilding the lexical index")
+            _lexical_index, _lexical_fingerprint = LexicalIndex.from_docs(DOCS_DIR), fingerprint
+    return _lexical_index
+
+
+def get_embedding(text: str, model: str = "text-embedding-3-small") -> np.ndarray:
+    """
+    Generates an embedding for the given text using OpenAI's API.
+    Results are served from the embedding cache whenever the same text was embedded before.
+    """
+    text = embedding_cache.normalize_text(text)
+    cache = embedding_cache.get_cache()
+    if cache:
+        cached = cache.get(model, text)
+        if cached is not None:
+            return cached
+
+    openai_client = get_openai_client()
     if not openai_client:
         raise ValueError("OpenAI client not initialized. Please set OPENAI_API_KEY.")
-    text = text.replace("\n", " ")
-    return openai_client.embeddings.create(input=[text], model=model).data[0].embedding
+    with admission.EMBEDDING.hold(), metrics.span("embedding"):
+        embedding = openai_client.embeddings.create(input=[text], model=model).data[0].embedding
+    if cache:
+        return cache.put(model, text, embedding)
+    return np.asarray(embedding, dtype=np.float32)
 
-def retrieve(query: str, k: int = 2) -> list[dict]:
+
+def _cached_embedding(model: str, text: str) -> np.ndarray | None:
+    cache = embedding_cache.get_cache()
+    return cache.get(model, text) if cache else None
+
+
+async def get_embedding_async(text: str, model: str = "text-embedding-3-small") -> np.ndarray:
     """
-    Retrieves the top-k most relevant API documents from Pinecone for a given query.
-    Returns the structured metadata for each retrieved document.
+    Async variant of `get_embedding`, sharing the same cache. Cache reads and
+    writes (which may hit sqlite) run on a thread, off the event loop.
     """
-    if not pinecone_index:
-        raise ValueError("Pinecone index not initialized. Please check your API keys and environment.")
-        
-    print(f"Retrieving top {k} docs for query: '{query}'")
-    
-    query_embedding = get_embedding(query)
-    
-    results = pinecone_index.query(
-        vector=query_embedding,
-        top_k=k,
-        include_metadata=True
-    )
-    
-    if not results['matches']:
-        print("Warning: No relevant API documentation found in Pinecone.")
-        return []
-        
-    # The full, structured document is now in the metadata
+    text = embedding_cache.normalize_text(text)
+    cached = await asyncio.to_thread(_cached_embedding, model, text)
+    if cached is not None:
+        return cached
+
+    async_openai_client = get_async_openai_client()
+    if not async_openai_client:
+        raise ValueError("OpenAI client not initialized. Please set OPENAI_API_KEY.")
+    async with admission.EMBEDDING.hold_async():
+        with metrics.span("embedding"):
+            response = await async_openai_client.embeddings.create(input=[text], model=model)
+    return await asyncio.to_thread(_remember, model, text, response.data[0].embedding)
+
+
+def _cached_embeddings(texts: list[str], model: str) -> tuple[list[str], list[np.ndarray | None], list[str]]:
+    """Normalizes texts and looks them up; returns (texts, vectors with None for misses, unique misses)."""
+    texts = [embedding_cache.normalize_text(text) for text in texts]
+    cache = embedding_cache.get_cache()
+    vectors = [cache.get(model, text) if cache else None for text in texts]
+    missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+    return texts, vectors, missing
+
+
+def _remember(model: str, text: str, embedding) -> np.ndarray:
+    cache = embedding_cache.get_cache()
+    if cache:
+        return cache.put(model, text, embedding)
+    return np.asarray(embedding, dtype=np.float32)
+
+
+def _remember_batch(model: str, chunk: list[str], response) -> dict[str, np.ndarray]:
+    """Caches the vectors of one embeddings response; returns them by input text."""
+    return {chunk[item.index]: _remember(model, chunk[item.index], item.embedding) for item in response.data}
+
+
+def get_embeddings(texts: list[str], model: str = "text-embedding-3-small") -> list[np.ndarray]:
+    """
+    Batched `get_embedding`: texts that aren't cached are deduplicated and sent
+    in as few embeddings requests as possible. Results are in input order.
+    """
+    texts, vectors, missing = _cached_embeddings(texts, model)
+    if missing:
+        openai_client = get_openai_client()
+        if not openai_client:
+            raise ValueError("OpenAI client not initialized. Please set OPENAI_API_KEY.")
+        fresh = {}
+        for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+            chunk = missing[start:start + EMBEDDING_BATCH_SIZE]
+            with admission.EMBEDDING.hold(), metrics.span("embedding", inputs=len(chunk)):
+                response = openai_client.embeddings.create(input=chunk, model=model)
+            fresh.update(_remember_batch(model, chunk, response))
+        vectors = [vector if vector is not None else fresh[text] for text, vector in zip(texts, vectors)]
+    return vectors
+
+
+async def get_embeddings_async(texts: list[str], model: str = "text-embedding-3-small") -> list[np.ndarray]:
+    """Async variant of `get_embeddings`; multiple request chunks are sent concurrently."""
+    texts, vectors, missing = await asyncio.to_thread(_cached_embeddings, texts, model)
+    if missing:
+        async_openai_client = get_async_openai_client()
+        if not async_openai_client:
+            raise ValueError("OpenAI client not initialized. Please set OPENAI_API_KEY.")
+        chunks = [missing[start:start + EMBEDDING_BATCH_SIZE] for start in range(0, len(missing), EMBEDDING_BATCH_SIZE)]
+        async with admission.EMBEDDING.hold_async():
+            with metrics.span("embedding", inputs=len(missing)):
+                responses = await asyncio.gather(*(
+                    async_openai_client.embeddings.create(input=chunk, model=model) for chunk in chunks
+                ))
+        fresh = {}
+        for chunk, response in zip(chunks, responses):
+            fresh.update(await asyncio.to_thread(_remember_batch, model, chunk, response))
+        vectors = [vector if vector is not None else fresh[text] for text, vector in zip(texts, vectors)]
+    return vectors
+
+
+def _to_docs(matches: list[dict]) -> list[dict]:
+    """Turns vector-store matches into the structured API docs stored in their metadata."""
     retrieved_docs = []
-    for match in results['matches']:
-        metadata = match['metadata']
+    for match in matches:
+        metadata = dict(match['metadata'])
         if 'examples' in metadata and isinstance(metadata['examples'], str):
             try:
                 metadata['examples'] = json.loads(metadata['examples'])
             except json.JSONDecodeError:
-                print(f"Warning: Could not decode 'examples' JSON for doc {metadata.get('name')}")
+                log.warning("Could not decode 'examples' JSON for doc %s", metadata.get('name'))
                 metadata['examples'] = []
         retrieved_docs.append(metadata)
+    return retrieved_docs
+
+
+def fuse(rankings: list[list[dict]], k: int = 2) -> list[dict]:
+    """
+    Reciprocal rank fusion: each match scores 1 / (RRF_K + rank) in every
+    ranking it appears in, and the k best summed scores win.
+    """
+    fused: dict[str, dict] = {}
+    for ranking in rankings:
+        for rank, match in enumerate(ranking, start=1):
+            entry = fused.setdefault(match["id"], {**match, "score": 0.0})
+            entry["score"] += 1.0 / (RRF_K + rank)
+    return sorted(fused.values(), key=lambda match: match["score"], reverse=True)[:k]
+
+
+def _lexical_matches(query: str) -> list[dict]:
+    if not LEXICAL_RETRIEVAL_ENABLED:
+        return []
+    with metrics.span("lexical_query"):
+        return get_lexical_index().query(query, top_k=FUSION_CANDIDATES)
+
+
+def _lexical_wins(matches: list[dict]) -> bool:
+    if not matches or matches[0]["score"] < LEXICAL_MIN_SCORE:
+        return False
+    runner_up = matches[1]["score"] if len(matches) > 1 else 0.0
+    return matches[0]["score"] >= LEXICAL_MARGIN * runner_up
+
+
+def lexical_match(query: str) -> str | None:
+    """The id of the doc BM25 alone would retrieve for the query, or None if it isn't decisive."""
+    matches = _lexical_matches(query)
+    return matches[0]["id"] if _lexical_wins(matches) else None
+
+
+def _combine(lexical: list[dict], vector: list[dict], k: int) -> tuple[list[dict], str]:
+    if lexical:
+        return fuse([vector, lexical], k), "hybrid"
+    return vector[:k], "vector"
+
+
+def _finish_retrieval(matches: list[dict], path: str, details: dict) -> list[dict]:
+    details["path"] = path
+    metrics.RETRIEVALS.inc(path=path)
+    if not matches:
+        log.warning("No relevant API documentation found.")
+        return []
+
+    # The full, structured document is now in the metadata
+    retrieved_docs = _to_docs(matches)
+
+    log.info("Retrieved docs (%s): %s", path, [doc.get('name', 'N/A') for doc in retrieved_docs])
+
+    return retrieved_docs
+
+
+def retrieve_with_path(query: str, k: int = 2) -> tuple[list[dict], str]:
+    """
+    Retrieves the top-k most relevant API documents for a given query, and
+    which path found them: "lexical" (BM25 alone, no embedding call),
+    "hybrid" (BM25 fused with vector search) or "vector".
+    """
+    log.info("Retrieving top %d docs for query: '%s'", k, query)
+
+    with metrics.span("retrieve") as details:
+        lexical = _lexical_matches(query)
+        if _lexical_wins(lexical):
+            return _finish_retrieval(lexical[:k], "lexical", details), "lexical"
+
+        backend = get_backend()
+        query_embedding = get_embedding(query)
+        with metrics.span("vector_query"):
+            vector = backend.query(query_embedding, top_k=max(k, FUSION_CANDIDATES) if lexical else k)
+        matches, path = _combine(lexical, vector, k)
+        return _finish_retrieval(matches, path, details), path
+
+
+def retrieve(query: str, k: int = 2) -> list[dict]:
+    """
+    Retrieves the top-k most relevant API documents for a given query.
+    Returns the structured metadata for each retrieved document.
+    """
+    return retrieve_with_path(query, k)[0]
+
+
+async def retrieve_with_path_async(query: str, k: int = 2) -> tuple[list[dict], str]:
+    """
+    Async variant of `retrieve_with_path` for the event-loop request path.
+    Loading or rebuilding an index happens on a thread, off the event loop.
+    """
+    log.info("Retrieving top %d docs for query: '%s'", k, query)
+
+    with metrics.span("retrieve") as details:
+        lexical = await asyncio.to_thread(_lexical_matches, query)
+        if _lexical_wins(lexical):
+            return _finish_retrieval(lexical[:k], "lexical", details), "lexical"
+
+        backend = await asyncio.to_thread(get_backend)
+        query_embedding = await get_embedding_async(query)
+        top_k = max(k, FUSION_CANDIDATES) if lexical else k
+        with metrics.span("vector_query"):
+            if hasattr(backend, "query_async"):
+                vector = await backend.query_async(query_embedding, top_k=top_k)
+            else:
+                # In-process backends answer in microseconds; no need for a thread.
+                vector = backend.query(query_embedding, top_k=top_k)
+        matches, path = _combine(lexical, vector, k)
+        return _finish_retrieval(matches, path, details), path
+
+
+async def retrieve_async(query: str, k: int = 2) -> list[dict]:
+    """Async variant of `retrieve` for the event-loop request path."""
+    return (await retrieve_with_path_async(query, k))[0]
+
+
+async def retrieve_batch_async(queries: list[str], k: int = 2) -> list[list[dict]]:
+    """
+    Retrieves the top-k docs for many queries at once. Queries BM25 answers
+    on its own skip embedding; the rest share one batched embeddings call
+    and one batched vector query (a single matmul on the local index).
+    """
+    log.info("Retrieving top %d docs for %d queries", k, len(queries))
+
+    results: list[list[dict] | None] = [None] * len(queries)
+    pending = []
+    with metrics.span("retrieve", queries=len(queries)) as details:
+        lexical = await asyncio.to_thread(lambda: [_lexical_matches(query) for query in queries])
+        for i, matches in enumerate(lexical):
+            if _lexical_wins(matches):
+                metrics.RETRIEVALS.inc(path="lexical")
+                results[i] = _to_docs(matches[:k])
+            else:
+                pending.append(i)
+        details["lexical"] = len(queries) - len(pending)
+
+        if pending:
+            backend = await asyncio.to_thread(get_backend)
+            embeddings = await get_embeddings_async([queries[i] for i in pending])
+            top_k = max(k, FUSION_CANDIDATES)
+            with metrics.span("vector_query", queries=len(pending)):
+                if hasattr(backend, "query_batch_async"):
+                    vector = await backend.query_batch_async(embeddings, top_k=top_k)
+                else:
+                    vector = backend.query_batch(embeddings, top_k=top_k)
+            for i, vector_matches in zip(pending, vector):
+                matches, path = _combine(lexical[i], vector_matches, k)
+                metrics.RETRIEVALS.inc(path=path)
+                results[i] = _to_docs(matches)
 
-    print(f"Retrieved docs: {[doc.get('name', 'N/A') for doc in retrieved_docs]}")
-    
-    return retrieved_docs 
\ No newline at end of file
+    return results
@@ -1,21 +1,129 @@
-from fastapi import APIRouter
-from pydantic import BaseModel
+import json
+from fastapi import APIRouter, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
+from pydantic import BaseModel, Field
+from typing import Optional
 import agent
+import admission
+import code_cache
+import embedding_cache
+import egress_proxy
+import metrics
+import warmup
 
 router = APIRouter()
 
+class SpeculationIn(BaseModel):
+    """Opts a request into speculative mode (see agent.SpeculationBudget)."""
+    candidates: int = Field(3, ge=1, le=agent.MAX_SPECULATIVE_CANDIDATES)
+    deadline: Optional[float] = Field(None, gt=0)
+
 class ChatIn(BaseModel):
     message: str
+    speculative: Optional[SpeculationIn] = None
+    # Adds a per-stage latency breakdown (`timings`) to the response.
+    timings: bool = False
+
+class BatchIn(BaseModel):
+    messages: list[str] = Field(..., min_length=1, max_length=agent.MAX_BATCH_SIZE)
+    concurrency: int = Field(agent.BATCH_CONCURRENCY, ge=1, le=64)
+    stream: bool = False
+
+def _budget(payload: ChatIn) -> agent.SpeculationBudget | None:
+    if payload.speculative is None:
+        return None
+    return agent.SpeculationBudget(**payload.speculative.model_dump())
 
 @router.post("/chat")
-def chat(payload: ChatIn):
+async def chat(payload: ChatIn, request: Request):
     """
     Receives a user's message, passes it to the agent,
-    and returns the agent's response.
+    and returns the agent's response. Answers 429/503 with Retry-After
+    when the server is saturated (see admission.py).
     """
+    admission.set_client(request)
     if not payload.message:
         return {"error": "Message cannot be empty."}
         
-    response = agent.handle_query(payload.message)
+    response = await agent.handle_query_async(payload.message, budget=_budget(payload), timings=payload.timings)
     
-    return response 
\ No newline at end of file
+    return response 
+
+@router.post("/chat/stream")
+async def chat_stream(payload: ChatIn, request: Request):
+    """
+    Streaming variant of /chat. Sends the agent's pipeline events as
+    Server-Sent Events; the last event is always `result`, carrying the
+    same body /chat would have returned.
+    """
+    admission.set_client(request)
+    if not payload.message:
+        return {"error": "Message cannot be empty."}
+    # Turn the request away before the stream starts if its queue is already full.
+    admission.REQUESTS.check()
+
+    async def events():
+        async for event in agent.stream_query(payload.message, budget=_budget(payload), timings=payload.timings):
+            yield f"event: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.post("/chat/batch")
+async def chat_batch(payload: BatchIn, request: Request):
+    """
+    Answers many messages in one request. Returns `{"results": [...]}` in
+    input order, each item carrying its `index`, `query` and the body /chat
+    would have returned. With `stream` set, items are sent as NDJSON lines
+    (still in input order) as soon as they are ready.
+    """
+    admission.set_client(request)
+    if not payload.stream:
+        return {"results": await agent.handle_batch_async(payload.messages, payload.concurrency)}
+
+    admission.REQUESTS.check()
+
+    async def lines():
+        async for item in agent.stream_batch(payload.messages, payload.concurrency):
+            yield json.dumps(item) + "\n"
+
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.get("/cache/stats")
+def cache_stats():
+    """Returns hit/miss counters for the generated-code, embedding and egress proxy caches, and request coalescing state."""
+    code = code_cache.get_cache()
+    embeddings = embedding_cache.get_cache()
+    return {
+        "code": code.stats() if code else {"enabled": False},
+        "embeddings": embeddings.stats() if embeddings else {"enabled": False},
+        "egress": egress_proxy.stats(),
+        "coalescing": agent.coalescing_stats(),
+    }
+
+@router.get("/admission/stats")
+def admission_stats():
+    """Current concurrency limit, in-flight work and queue length of each admission stage."""
+    return admission.stats()
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Request, stage and sandbox latency histograms plus token and retry counters, in Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@router.get("/health/live")
+def liveness():
+    """The process is up and serving requests; it says nothing about warm-up."""
+    return {"status": "alive"}
+
+@router.get("/health/ready")
+def readiness():
+    """503 until the startup warm-up has finished, then 200 with how each step went ("degraded" if one failed)."""
+    return JSONResponse(warmup.status(), status_code=200 if warmup.ready() else 503)
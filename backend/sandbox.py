@@ -0,0 +1,614 @@
+import os
+import sys
+import io
+import time
+import queue
+import codecs
+import signal
+import asyncio
+import atexit
+import logging
+import linecache
+import builtins
+import importlib
+import tempfile
+import threading
+import traceback
+import subprocess
+import multiprocessing
+from contextlib import redirect_stdout, redirect_stderr
+from dataclasses import dataclass
+from pathlib import Path
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Pool configuration. A pool size of 0 disables the pool and every script is
+# executed in a freshly spawned interpreter (the original behaviour).
+POOL_SIZE = int(os.environ.get("SANDBOX_POOL_SIZE", "4"))
+MAX_JOBS_PER_WORKER = int(os.environ.get("SANDBOX_MAX_JOBS_PER_WORKER", "50"))
+ACQUIRE_TIMEOUT = float(os.environ.get("SANDBOX_ACQUIRE_TIMEOUT", "2"))
+
+# How often a running pool job checks whether its caller cancelled it.
+CANCEL_POLL_INTERVAL = 0.05
+
+# Modules imported once per worker so generated scripts don't pay for them.
+PRELOAD_MODULES = ("json", "httpx")
+
+# Where fork() is available each job runs in a fork of its warm worker, so
+# nothing a script changes (environment, cwd, sys.modules, monkeypatches)
+# outlives it. Elsewhere jobs run in the worker itself, which restores the
+# environment and cwd afterwards and is replaced if loaded modules changed.
+FORK_JOBS = hasattr(os, "fork")
+
+# Holds the egress hook (and a sitecustomize that installs it in cold children).
+SITE_DIR = Path(__file__).parent / "sandbox_site"
+
+
+@dataclass
+class ExecResult:
+    """Outcome of running one generated script."""
+    returncode: int
+    stdout: str
+    stderr: str
+    timed_out: bool = False
+    # "pool" for a warm worker (no spawn on the request path) or "cold".
+    mode: str = "pool"
+    spawn_seconds: float = 0.0
+
+
+class WorkerCrashed(Exception):
+    """Raised when a pool worker was found dead before a job was sent to it; the job can run elsewhere."""
+
+
+class PoolBusy(Exception):
+    """Raised when no idle worker became available within ACQUIRE_TIMEOUT."""
+
+
+class JobCancelled(Exception):
+    """Raised when a job's cancel event was set while its script was running."""
+
+
+# --- Worker side -----------------------------------------------------------
+
+def _exit_code(code) -> int:
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+class _ChunkWriter(io.TextIOBase):
+    """Forwards each write to the parent, which keeps the output (so a killed job's output isn't lost)."""
+
+    def __init__(self, conn, stream: str):
+        super().__init__()
+        self._conn = conn
+        self._stream = stream
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        if s:
+            self._conn.send((self._stream, s))
+        return len(s)
+
+
+def _script_path() -> str:
+    # What `__file__` and tracebacks show; the source is served from linecache.
+    return os.path.join(tempfile.gettempdir(), f"sandbox_job_{os.getpid()}.py")
+
+
+def _execute(code: str) -> int:
+    """
+    Runs a script in a clean namespace, mirroring `python script.py`, and
+    returns its exit code. Output goes to the current sys.stdout/sys.stderr.
+    """
+    path = _script_path()
+    linecache.cache[path] = (len(code), None, code.splitlines(True), path)
+    namespace = {"__name__": "__main__", "__file__": path, "__builtins__": builtins}
+    sys.argv = [path]
+    try:
+        exec(compile(code, path, "exec"), namespace)
+    except SystemExit as e:
+        return _exit_code(e.code)
+    except BaseException:
+        # Drop this frame so the traceback starts at the generated script.
+        etype, value, tb = sys.exc_info()
+        traceback.print_exception(etype, value, tb.tb_next)
+        return 1
+    return 0
+
+
+def _forward(read_fd: int, stream: str, conn, lock: threading.Lock):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while True:
+        data = os.read(read_fd, 65536)
+        text = decoder.decode(data, final=not data)
+        if text:
+            with lock:
+                conn.send((stream, text))
+        if not data:
+            break
+    os.close(read_fd)
+
+
+def _capture_output(conn) -> list[threading.Thread]:
+    """
+    Points fds 1 and 2 at pipes whose contents are forwarded to `conn`, and
+    sys.stdout/sys.stderr (and sys.__stdout__/__stderr__) at them, so writes
+    through any of them are captured as in a child with piped output.
+    """
+    lock = threading.Lock()
+    readers = []
+    for fd, stream in ((1, "stdout"), (2, "stderr")):
+        read_fd, write_fd = os.pipe()
+        os.dup2(write_fd, fd)
+        os.close(write_fd)
+        reader = threading.Thread(target=_forward, args=(read_fd, stream, conn, lock), daemon=True)
+        reader.start()
+        readers.append(reader)
+    sys.stdout = sys.__stdout__ = open(1, "w", encoding="utf-8", buffering=1, closefd=False)
+    sys.stderr = sys.__stderr__ = open(2, "w", encoding="utf-8", buffering=1, closefd=False)
+    return readers
+
+
+def _finish_forked(readers: list[threading.Thread]):
+    """Does what interpreter shutdown would: joins non-daemon threads, runs atexit handlers, flushes output."""
+    threading._shutdown()
+    atexit._run_exitfuncs()
+    for stream in (sys.stdout, sys.stderr, sys.__stdout__, sys.__stderr__):
+        try:
+            stream.flush()
+        except Exception:
+            pass
+    for fd in (1, 2):
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    for reader in readers:
+        reader.join()
+
+
+def _run_forked(code: str, conn, env: dict) -> int:
+    """Runs the job in a fork of this worker and returns its exit status (-N if killed by signal N)."""
+    pid = os.fork()
+    if pid == 0:
+        returncode = 1
+        try:
+            # Only the exit handlers the script registers run when it ends.
+            atexit._clear()
+            os.environ.update(env)
+            readers = _capture_output(conn)
+            returncode = _execute(code)
+            _finish_forked(readers)
+        finally:
+            os._exit(returncode)
+    _, status = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status)
+
+
+def _module_state() -> tuple[set, dict]:
+    return set(sys.modules), {name: dict(vars(sys.modules[name])) for name in PRELOAD_MODULES if name in sys.modules}
+
+
+def _run_in_place(code: str, conn, env: dict) -> tuple[int, bool]:
+    """
+    Runs the job in this worker, then restores the environment and cwd.
+    Returns the exit code and whether the script changed loaded modules (the worker must be replaced).
+    """
+    saved_env, saved_cwd, saved_argv = dict(os.environ), os.getcwd(), sys.argv
+    modules = _module_state()
+    os.environ.update(env)
+    try:
+        with redirect_stdout(_ChunkWriter(conn, "stdout")), redirect_stderr(_ChunkWriter(conn, "stderr")):
+            returncode = _execute(code)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+        os.chdir(saved_cwd)
+        sys.argv = saved_argv
+        linecache.cache.pop(_script_path(), None)
+    return returncode, _module_state() != modules
+
+
+def _worker_main(conn):
+    if hasattr(os, "setsid"):
+        # Own process group, so killing the worker also kills the job it forked.
+        os.setsid()
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    sys.path.insert(0, str(SITE_DIR))
+    importlib.import_module("egress_hook").install()
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        code, env = job
+        if FORK_JOBS:
+            returncode, dirty = _run_forked(code, conn, env), False
+        else:
+            returncode, dirty = _run_in_place(code, conn, env)
+        conn.send(("done", returncode, dirty))
+
+
+# --- Parent side -----------------------------------------------------------
+
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        start = time.perf_counter()
+        self.process.start()
+        metrics.SANDBOX_SPAWN_SECONDS.observe(time.perf_counter() - start, mode="pool")
+        child_conn.close()
+        self.jobs = 0
+        self.reusable = True
+
+    def run(self, code: str, timeout: float, on_output=None, env: dict | None = None,
+            cancel: threading.Event | None = None) -> ExecResult:
+        """
+        Runs one job. If `on_output` is given it is called with
+        ("stdout"|"stderr", text) as the script writes. A job that runs past
+        `timeout` returns `timed_out` with the output so far, as does (with
+        the worker's exit code) one that takes the worker down with it;
+        `reusable` is then False. Raises WorkerCrashed if the worker was
+        already dead, before the job was sent, and JobCancelled soon after
+        `cancel` is set.
+        """
+        if not self.process.is_alive():
+            raise WorkerCrashed(f"worker exited with code {self.process.exitcode}")
+        try:
+            self.conn.send((code, env or {}))
+        except OSError as e:
+            raise WorkerCrashed(str(e)) from e
+
+        self.reusable = False
+        output = {"stdout": [], "stderr": []}
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                remaining = max(0, deadline - time.monotonic())
+                wait = min(remaining, CANCEL_POLL_INTERVAL) if cancel is not None else remaining
+                if not self.conn.poll(wait):
+                    if cancel is not None and cancel.is_set():
+                        raise JobCancelled()
+                    if time.monotonic() >= deadline:
+                        return ExecResult(-9, "".join(output["stdout"]), "".join(output["stderr"]), timed_out=True)
+                    continue
+                message = self.conn.recv()
+                if message[0] == "done":
+                    break
+                output[message[0]].append(message[1])
+                if on_output:
+                    on_output(*message)
+        except (EOFError, OSError):
+            # The script took the worker down (only possible when jobs aren't forked).
+            self.process.join(timeout=1)
+            returncode = self.process.exitcode if self.process.exitcode is not None else -9
+            return ExecResult(returncode, "".join(output["stdout"]), "".join(output["stderr"]))
+        _, returncode, dirty = message
+        self.jobs += 1
+        self.reusable = not dirty
+        return ExecResult(returncode, "".join(output["stdout"]), "".join(output["stderr"]))
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.kill()
+        self.conn.close()
+
+    def kill(self):
+        if hasattr(os, "killpg"):
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.process.kill()
+        self.process.join()
+
+
+class WorkerPool:
+    """
+    A fixed-size pool of long-lived, pre-warmed interpreter processes.
+    Each worker runs one script at a time (see FORK_JOBS); a worker whose job
+    timed out, died or left it dirty is killed and replaced, and every worker
+    is recycled after `max_jobs` scripts.
+    """
+
+    def __init__(self, size: int = POOL_SIZE, max_jobs: int = MAX_JOBS_PER_WORKER,
+                 acquire_timeout: float = ACQUIRE_TIMEOUT):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.acquire_timeout = acquire_timeout
+        self._ctx = multiprocessing.get_context("spawn")
+        self._idle: queue.Queue[_Worker] = queue.Queue()
+        self._closed = False
+
+    def start(self):
+        for _ in range(self.size):
+            self._idle.put(_Worker(self._ctx))
+
+    def run(self, code: str, timeout: float, acquire_timeout: float | None = None,
+            on_output=None, env: dict | None = None, cancel: threading.Event | None = None) -> ExecResult:
+        if acquire_timeout is None:
+            acquire_timeout = self.acquire_timeout
+        try:
+            worker = self._idle.get(block=acquire_timeout > 0, timeout=acquire_timeout or None)
+        except queue.Empty:
+            raise PoolBusy(f"No sandbox worker free after {acquire_timeout}s")
+
+        try:
+            result = worker.run(code, timeout, on_output, env, cancel)
+        except (WorkerCrashed, JobCancelled):
+            worker.kill()
+            self._release(_Worker(self._ctx))
+            raise
+
+        if not worker.reusable:
+            worker.kill()
+            worker = _Worker(self._ctx)
+        elif worker.jobs >= self.max_jobs:
+            worker.close()
+            worker = _Worker(self._ctx)
+        self._release(worker)
+        return result
+
+    def _release(self, worker: _Worker):
+        if self._closed:
+            worker.close()
+        else:
+            self._idle.put(worker)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pool: WorkerPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> WorkerPool | None:
+    """Returns the process-wide pool, starting it on first use."""
+    global _pool
+    if POOL_SIZE <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            pool = WorkerPool()
+            pool.start()
+            _pool = pool
+            atexit.register(shutdown_pool)
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def child_env() -> dict[str, str]:
+    """Extra environment for generated scripts: routes their httpx traffic through the egress proxy."""
+    # Deferred import: pool workers import this module but never run the proxy.
+    import egress_proxy
+
+    try:
+        proxy = egress_proxy.get_proxy()
+    except Exception as e:
+        log.warning("Egress proxy unavailable (%s); scripts will call APIs directly.", e)
+        return {}
+    return {"SANDBOX_EGRESS_PROXY": proxy.url} if proxy else {}
+
+
+def _cold_env(env: dict | None) -> dict | None:
+    """Full environment for a cold child; None (inherit) when there is nothing to add."""
+    if not env:
+        return None
+    pythonpath = os.pathsep.join(filter(None, [str(SITE_DIR), os.environ.get("PYTHONPATH")]))
+    return {**os.environ, **env, "PYTHONPATH": pythonpath}
+
+
+def run_cold(code: str, timeout: float, env: dict | None = None) -> ExecResult:
+    """Executes a script in a brand new interpreter process."""
+    with tempfile.NamedTemporaryFile("w", delete=False, suffix=".py", encoding='utf-8') as tf:
+        tf.write(code)
+        temp_filename = tf.name
+
+    try:
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, temp_filename],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            env=_cold_env(env),
+        )
+        spawn_seconds = _record_spawn(start)
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            stdout, stderr = proc.communicate()
+            return ExecResult(-9, _as_text(stdout), _as_text(stderr), True, "cold", spawn_seconds)
+        return ExecResult(proc.returncode, stdout, stderr, False, "cold", spawn_seconds)
+    finally:
+        os.unlink(temp_filename)
+
+
+async def run_cold_async(code: str, timeout: float, on_output=None, env: dict | None = None) -> ExecResult:
+    """
+    Async variant of `run_cold`; the child is killed on timeout or cancellation.
+    If `on_output` is given it is called with ("stdout"|"stderr", text) as the
+    child writes, and the child runs unbuffered so chunks arrive promptly.
+    """
+    with tempfile.NamedTemporaryFile("w", delete=False, suffix=".py", encoding='utf-8') as tf:
+        tf.write(code)
+        temp_filename = tf.name
+
+    args = [sys.executable, "-u", temp_filename] if on_output else [sys.executable, temp_filename]
+    stdout, stderr = [], []
+    proc = None
+    try:
+        start = time.perf_counter()
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=_cold_env(env),
+        )
+        spawn_seconds = _record_spawn(start)
+        async def communicate():
+            await asyncio.gather(
+                _pump(proc.stdout, "stdout", stdout, on_output),
+                _pump(proc.stderr, "stderr", stderr, on_output),
+                proc.wait(),
+            )
+
+        try:
+            await asyncio.wait_for(communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return ExecResult(-9, "".join(stdout), "".join(stderr), True, "cold", spawn_seconds)
+        return ExecResult(proc.returncode, "".join(stdout), "".join(stderr), False, "cold", spawn_seconds)
+    finally:
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+        os.unlink(temp_filename)
+
+
+async def _pump(reader, stream: str, chunks: list[str], on_output):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while True:
+        data = await reader.read(4096)
+        text = decoder.decode(data, final=not data)
+        if text:
+            chunks.append(text)
+            if on_output:
+                on_output(stream, text)
+        if not data:
+            break
+
+
+def _record_spawn(start: float) -> float:
+    seconds = time.perf_counter() - start
+    metrics.SANDBOX_SPAWN_SECONDS.observe(seconds, mode="cold")
+    return seconds
+
+
+def _as_text(data) -> str:
+    if data is None:
+        return ""
+    if isinstance(data, bytes):
+        return data.decode("utf-8", errors="replace")
+    return data
+
+
+def execute(code: str, timeout: float) -> ExecResult:
+    """
+    Runs a script on a warm pool worker, falling back to a cold spawn when the
+    pool is disabled, saturated, or the worker was dead before it got the job.
+    """
+    env = child_env()
+    pool = get_pool()
+    if pool is not None:
+        try:
+            return pool.run(code, timeout, env=env)
+        except (PoolBusy, WorkerCrashed) as e:
+            log.warning("Sandbox pool unavailable (%s); falling back to cold spawn.", e)
+    return run_cold(code, timeout, env)
+
+
+def _pool_and_env() -> tuple[WorkerPool | None, dict]:
+    # Either may start processes or threads on first use, so async callers run this on a thread.
+    return get_pool(), child_env()
+
+
+async def _run_on_pool(pool: WorkerPool, code: str, timeout: float, on_output=None,
+                       env: dict | None = None) -> ExecResult:
+    """Runs a job on an idle worker from async code; cancelling the caller kills the script."""
+    cancel = threading.Event()
+    try:
+        return await asyncio.to_thread(pool.run, code, timeout, 0, on_output, env, cancel)
+    except asyncio.CancelledError:
+        cancel.set()
+        raise
+
+
+async def execute_async(code: str, timeout: float) -> ExecResult:
+    """
+    Async variant of `execute`. Only an idle worker is used (no queueing on a
+    thread); otherwise the script runs in an asyncio-managed cold subprocess.
+    """
+    pool, env = await asyncio.to_thread(_pool_and_env)
+    if pool is not None:
+        try:
+            return await _run_on_pool(pool, code, timeout, env=env)
+        except PoolBusy:
+            pass
+        except WorkerCrashed as e:
+            log.warning("Sandbox pool unavailable (%s); falling back to cold spawn.", e)
+    return await run_cold_async(code, timeout, env=env)
+
+
+async def stream_execute(code: str, timeout: float):
+    """
+    Runs a script like `execute_async`, yielding ("stdout"|"stderr", text)
+    as output is produced and finally ("result", ExecResult).
+    """
+    loop = asyncio.get_running_loop()
+    chunks: asyncio.Queue = asyncio.Queue()
+    pool, env = await asyncio.to_thread(_pool_and_env)
+
+    def on_output(stream: str, text: str):
+        loop.call_soon_threadsafe(chunks.put_nowait, (stream, text))
+
+    async def run() -> ExecResult:
+        if pool is not None:
+            try:
+                return await _run_on_pool(pool, code, timeout, on_output, env)
+            except PoolBusy:
+                pass
+            except WorkerCrashed as e:
+                log.warning("Sandbox pool unavailable (%s); falling back to cold spawn.", e)
+        return await run_cold_async(code, timeout, on_output, env)
+
+    task = asyncio.create_task(run())
+    try:
+        while True:
+            getter = asyncio.ensure_future(chunks.get())
+            done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                yield getter.result()
+                continue
+            getter.cancel()
+            break
+        while not chunks.empty():
+            yield chunks.get_nowait()
+        yield ("result", task.result())
+    finally:
+        if not task.done():
+            task.cancel()
@@ -0,0 +1,53 @@
+"""
+Routes httpx requests made by generated scripts through the backend's egress
+proxy. The proxy address comes from SANDBOX_EGRESS_PROXY (read per request);
+the real target travels in the X-Egress-Url header so https:// requests can
+be pooled and cached by the proxy instead of being tunnelled.
+"""
+import os
+
+EGRESS_ENV = "SANDBOX_EGRESS_PROXY"
+TARGET_HEADER = "X-Egress-Url"
+
+
+def _route(request):
+    """Points the request at the proxy; returns the original URL, or None to go direct."""
+    proxy = os.environ.get(EGRESS_ENV)
+    if not proxy or request.url.scheme not in ("http", "https") or str(request.url).startswith(proxy):
+        return None
+    target = request.url
+    request.headers[TARGET_HEADER] = str(target)
+    request.url = type(target)(proxy)
+    return target
+
+
+def install():
+    try:
+        import httpx
+    except ImportError:
+        return
+    if getattr(httpx.HTTPTransport, "_egress_hooked", False):
+        return
+
+    sync_handle = httpx.HTTPTransport.handle_request
+    async_handle = httpx.AsyncHTTPTransport.handle_async_request
+
+    def handle_request(self, request):
+        target = _route(request)
+        try:
+            return sync_handle(self, request)
+        finally:
+            if target is not None:
+                request.url = target
+
+    async def handle_async_request(self, request):
+        target = _route(request)
+        try:
+            return await async_handle(self, request)
+        finally:
+            if target is not None:
+                request.url = target
+
+    httpx.HTTPTransport.handle_request = handle_request
+    httpx.AsyncHTTPTransport.handle_async_request = handle_async_request
+    httpx.HTTPTransport._egress_hooked = True
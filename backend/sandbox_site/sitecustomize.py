@@ -0,0 +1,5 @@
+# Loaded automatically by cold-spawned sandbox interpreters (this directory is
+# put on their PYTHONPATH) to route httpx traffic through the egress proxy.
+import egress_hook
+
+egress_hook.install()
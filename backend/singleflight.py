@@ -0,0 +1,106 @@
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Awaitable, Callable
+import metrics
+
+# "0" turns request coalescing off; every request then runs its own pipeline.
+COALESCE_ENABLED = os.environ.get("COALESCE_ENABLED", "1") != "0"
+# Seconds a finished result is still handed to new identical requests.
+# 0 only coalesces requests whose pipeline runs overlap.
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", "2"))
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time: callers arriving while a call with the
+    same key is in flight wait for it and get its result (or its exception)
+    instead of starting their own. Results accepted by `keep` are shared for
+    another `window` seconds after the call finishes.
+
+    In-flight calls are tracked as concurrent.futures.Future objects, so
+    callers on different event loops (the server's, and the one blocking
+    callers use, see background.run) can join each other's calls.
+    """
+
+    def __init__(self, window: float = COALESCE_WINDOW, keep: Callable[[dict], bool] = lambda result: True):
+        self.window = window
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._flights: dict[str, Future] = {}
+        # key -> (expiry, result), in expiry order since the window is fixed
+        self._results: dict[str, tuple[float, dict]] = {}
+
+    def _join(self, key: str) -> tuple[Future | None, dict | None]:
+        """Returns (future, None) for a call to wait on, (None, result) for a shared result, or (None, None) to lead."""
+        with self._lock:
+            shared = self._results.get(key)
+            if shared is not None:
+                if shared[0] > time.monotonic():
+                    return None, shared[1]
+                del self._results[key]
+            future = self._flights.get(key)
+            if future is not None:
+                return future, None
+            self._flights[key] = Future()
+            return None, None
+
+    def _land(self, key: str, result: dict | None = None, error: BaseException | None = None):
+        with self._lock:
+            future = self._flights.pop(key)
+            now = time.monotonic()
+            while self._results and next(iter(self._results.values()))[0] <= now:
+                del self._results[next(iter(self._results))]
+            if error is None and self.window > 0 and self.keep(result):
+                self._results[key] = (now + self.window, result)
+        if isinstance(error, asyncio.CancelledError):
+            future.cancel()
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    @staticmethod
+    def _followed(shared: str, started: float):
+        metrics.COALESCED.inc(shared=shared)
+        metrics.record("coalesced", time.perf_counter() - started, shared=shared)
+
+    async def run_async(self, key: str, factory: Callable[[], Awaitable[dict]]) -> dict:
+        """
+        Returns the result of the coroutine `factory` returns, or that of an
+        identical call in flight or just finished. The call runs in its own
+        task, so a leader whose client goes away doesn't cancel it for the
+        requests waiting on it.
+        """
+        started = time.perf_counter()
+        future, shared = self._join(key)
+        if shared is not None:
+            self._followed("window", started)
+            return shared
+        if future is not None:
+            result = await asyncio.shield(asyncio.wrap_future(future))
+            self._followed("inflight", started)
+            return result
+
+        try:
+            task = asyncio.ensure_future(factory())
+        except BaseException as e:
+            self._land(key, error=e)
+            raise
+
+        def land(task: asyncio.Task):
+            if task.cancelled():
+                self._land(key, error=asyncio.CancelledError())
+            elif task.exception() is not None:
+                self._land(key, error=task.exception())
+            else:
+                self._land(key, task.result())
+
+        task.add_done_callback(land)
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": len(self._flights), "shared_results": len(self._results), "window_s": self.window}
@@ -0,0 +1,138 @@
+import re
+import ast
+import json
+from dataclasses import dataclass
+
+# Failures worth simply running again: network errors and timeouts talking
+# to the upstream API, rate limiting and 5xx responses.
+TRANSIENT_PATTERNS = re.compile(
+    r"(?:httpx|httpcore|requests\.exceptions)\.(?:ConnectTimeout|ReadTimeout|WriteTimeout|PoolTimeout|Timeout"
+    r"|TimeoutException|ConnectError|ConnectionError|ReadError|WriteError|RemoteProtocolError|NetworkError)"
+    r"|\b(?:ConnectionResetError|ConnectionRefusedError|socket\.timeout)\b"
+    r"|(?:Server error|Client error) '(?:429|5\d\d)|\b(?:429 Too Many Requests|502 Bad Gateway|503 Service Unavailable"
+    r"|504 Gateway Timeout)\b|\btimed out\b",
+    re.IGNORECASE,
+)
+
+# Names a script may use without importing them, and the import that fixes it.
+KNOWN_IMPORTS = {
+    "json": "import json",
+    "httpx": "import httpx",
+    "re": "import re",
+    "os": "import os",
+    "sys": "import sys",
+    "math": "import math",
+    "time": "import time",
+    "random": "import random",
+    "base64": "import base64",
+    "urllib": "import urllib.parse",
+    "datetime": "import datetime",
+    "date": "from datetime import date",
+    "timedelta": "from datetime import timedelta",
+}
+
+_NAME_ERROR = re.compile(r"NameError: name '(\w+)' is not defined")
+_FENCE_LINE = re.compile(r"^\s*```[\w-]*\s*$", re.MULTILINE)
+
+
+@dataclass
+class Triage:
+    """
+    What went wrong with one run and what to do about it. `kind` is "ok",
+    "transient" (run it again), "mechanical" (run `code` instead, or use
+    `output` as is) or "logical" (only Claude can fix it).
+    """
+    kind: str
+    code: str | None = None
+    output: str | None = None
+    reason: str = ""
+
+
+def _failure_text(output: str) -> str | None:
+    """The error a run reported (the whole output for a crash, the `error` of a JSON error), or None."""
+    if "Error executing code:" in output:
+        return output
+    try:
+        data = json.loads(output)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(data, dict) and "error" in data:
+        return str(data["error"])
+    return None
+
+
+def extract_json(stdout: str) -> str | None:
+    """The last JSON object or array printed amid other text (e.g. progress messages), re-serialized."""
+    decoder = json.JSONDecoder()
+    found = None
+    for match in re.finditer(r"^[ \t]*[\[{]", stdout, re.MULTILINE):
+        try:
+            value, _ = decoder.raw_decode(stdout[match.end() - 1:])
+        except json.JSONDecodeError:
+            continue
+        if isinstance(value, (dict, list)):
+            found = value
+    return json.dumps(found, indent=2) if found is not None else None
+
+
+def _parses(code: str) -> bool:
+    try:
+        ast.parse(code)
+    except SyntaxError:
+        return False
+    return True
+
+
+def _add_import(code: str, statement: str) -> str:
+    """Inserts the import after the module docstring and any __future__ imports."""
+    tree = ast.parse(code)
+    line = 0
+    for node in tree.body:
+        is_docstring = isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+        if is_docstring or (isinstance(node, ast.ImportFrom) and node.module == "__future__"):
+            line = node.end_lineno
+        else:
+            break
+    lines = code.splitlines()
+    return "\n".join(lines[:line] + [statement] + lines[line:])
+
+
+def _repair_code(code: str, error: str) -> tuple[str, str] | None:
+    """A locally fixed script and what was fixed, or None if the failure isn't a known mechanical one."""
+    if "SyntaxError" in error and _FENCE_LINE.search(code):
+        fixed = _FENCE_LINE.sub("", code).strip()
+        if _parses(fixed):
+            return fixed, "removed markdown fences"
+
+    match = _NAME_ERROR.search(error)
+    if match and match.group(1) in KNOWN_IMPORTS and _parses(code):
+        statement = KNOWN_IMPORTS[match.group(1)]
+        if statement not in code:
+            return _add_import(code, statement), f"added `{statement}`"
+    return None
+
+
+def triage(code: str, output: str) -> Triage:
+    """Classifies the output of running `code` and, for mechanical failures, proposes the fix."""
+    failure = _failure_text(output)
+    if failure is None:
+        try:
+            json.loads(output)
+            return Triage("ok")
+        except json.JSONDecodeError:
+            pass
+        extracted = extract_json(output)
+        if extracted is not None:
+            return Triage("mechanical", output=extracted, reason="extracted the JSON from stdout")
+        return Triage("logical", reason="output is not JSON")
+
+    if "Timed out after" in failure:
+        # Our own execution timeout: the script hung or looped, re-running won't help.
+        return Triage("logical", reason="execution timed out")
+    if TRANSIENT_PATTERNS.search(failure):
+        return Triage("transient", reason="network error or rate limit")
+
+    repaired = _repair_code(code, failure)
+    if repaired is not None:
+        return Triage("mechanical", code=repaired[0], reason=repaired[1])
+    return Triage("logical", reason="script error")
@@ -0,0 +1,170 @@
+import os
+import re
+import sys
+import time
+import asyncio
+import inspect
+import logging
+import subprocess
+import egress_proxy
+import sandbox
+import agent
+import llm
+import rag
+
+log = logging.getLogger(__name__)
+
+# "0" skips the warm-up: the app is ready at once and every resource below
+# is set up by the first request that needs it.
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "1") != "0"
+# Seconds startup waits for the warm-up before accepting traffic anyway;
+# the rest finishes in the background and /health/ready reports it.
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT", "20"))
+# Target for importing the app (seconds); a slower import logs a warning,
+# and `python warmup.py` exits non-zero.
+IMPORT_TIME_BUDGET = float(os.environ.get("IMPORT_TIME_BUDGET", "1.5"))
+
+_import_seconds: float | None = None
+# step -> {"status": "pending" | "ok" | "failed", "ms": ..., "error": ...}
+_steps: dict[str, dict] = {}
+_finished = False
+_task: asyncio.Task | None = None
+
+
+def record_import(seconds: float):
+    """Records how long importing the app took and warns when it's over the budget."""
+    global _import_seconds
+    _import_seconds = seconds
+    if seconds > IMPORT_TIME_BUDGET:
+        log.warning("Importing the app took %.2fs, over the %.2fs budget.", seconds, IMPORT_TIME_BUDGET)
+    else:
+        log.info("Imported the app in %.2fs.", seconds)
+
+
+# The provider steps build the client and make one cheap authenticated call,
+# leaving a keep-alive connection (DNS, TCP and TLS done) in its pool.
+async def _llm():
+    client = await asyncio.to_thread(llm.get_async_client)
+    if client is None:
+        raise ValueError("CLAUDE_API_KEY is not set")
+    await client.models.list(limit=1)
+
+
+async def _embeddings():
+    client = await asyncio.to_thread(rag.get_async_openai_client)
+    if client is None:
+        raise ValueError("OpenAI client not initialized")
+    # One model rather than the whole list; the SDK's models.list() takes no limit.
+    await client.models.retrieve("text-embedding-3-small")
+
+
+def _retrieval():
+    rag.get_lexical_index()
+    backend = rag.get_backend()
+    if isinstance(backend, rag.PineconeBackend) and backend.index is None:
+        raise ValueError("Pinecone index not initialized")
+
+
+def _sandbox():
+    sandbox.get_pool()
+    egress_proxy.get_proxy()
+
+
+async def _step(name: str, run):
+    """Runs one step (a coroutine function, or a blocking function in a thread) and records how it went."""
+    started = time.perf_counter()
+    try:
+        if inspect.iscoroutinefunction(run):
+            await run()
+        else:
+            await asyncio.to_thread(run)
+    except Exception as e:
+        # Not fatal: whatever failed is set up again by the first request that needs it.
+        log.warning("Warm-up step %s failed: %s", name, e)
+        _steps[name].update(status="failed", error=str(e))
+    else:
+        _steps[name]["status"] = "ok"
+    _steps[name]["ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+
+async def _warm_up(steps: dict):
+    global _finished
+    started = time.perf_counter()
+    await asyncio.gather(*(_step(name, run) for name, run in steps.items()))
+    _finished = True
+    log.info("Warm-up finished in %.2fs: %s", time.perf_counter() - started,
+             ", ".join(f"{name} {step['status']}" for name, step in _steps.items()))
+
+
+async def start():
+    """
+    Warms the app up before it accepts traffic: connects to the providers,
+    loads the retrieval indexes, compiles the API templates and spawns the
+    sandbox pool, concurrently. Waits at most WARMUP_TIMEOUT seconds.
+    """
+    global _finished, _task
+    if not WARMUP_ENABLED:
+        _finished = True
+        return
+    steps = {
+        "llm": _llm,
+        "embeddings": _embeddings,
+        "retrieval": _retrieval,
+        "templates": agent.compile_templates,
+        "sandbox": _sandbox,
+    }
+    _steps.update({name: {"status": "pending"} for name in steps})
+    _task = asyncio.ensure_future(_warm_up(steps))
+    try:
+        await asyncio.wait_for(asyncio.shield(_task), WARMUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        log.warning("Warm-up still running after %gs; accepting traffic, /health/ready turns ready when it ends.",
+                    WARMUP_TIMEOUT)
+
+
+async def stop():
+    if _task is not None and not _task.done():
+        _task.cancel()
+
+
+def ready() -> bool:
+    return _finished
+
+
+def status() -> dict:
+    failed = [name for name, step in _steps.items() if step["status"] == "failed"]
+    return {
+        "status": "warming" if not _finished else "degraded" if failed else "ready",
+        "import_s": round(_import_seconds, 3) if _import_seconds is not None else None,
+        "import_budget_s": IMPORT_TIME_BUDGET,
+        "steps": _steps,
+    }
+
+
+def measure_import(module: str = "main") -> tuple[float, list[tuple[float, str]]]:
+    """
+    Imports `module` in a fresh interpreter under `python -X importtime`.
+    Returns the cumulative import time (seconds) and each module's own time, slowest first.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+    )
+    total, own = 0.0, []
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)", line)
+        if not match:
+            continue
+        own.append((int(match.group(1)) / 1e6, match.group(4)))
+        if match.group(4) == module and len(match.group(3)) == 1:  # the top-level import
+            total = int(match.group(2)) / 1e6
+    return total, sorted(own, reverse=True)
+
+
+if __name__ == "__main__":
+    total, own = measure_import()
+    print(f"import main: {total:.3f}s (budget {IMPORT_TIME_BUDGET:.3f}s)")
+    print("slowest modules (self time):")
+    for seconds, name in own[:10]:
+        print(f"  {seconds * 1000:8.1f} ms  {name}")
+    sys.exit(0 if total <= IMPORT_TIME_BUDGET else 1)
@@ -1,5 +1,4 @@
 import { useState, useRef, useEffect } from "react";
-import axios from "axios";
 
 export default function Chat() {
   const [input, setInput] = useState("");
@@ -16,31 +15,113 @@ export default function Chat() {
     scrollToBottom();
   }, [log]);
 
+  // Applies a change to the most recent log entry.
+  const updateLast = (update) => {
+    setLog(prevLog => {
+      const newLog = [...prevLog];
+      newLog[newLog.length - 1] = { ...newLog[newLog.length - 1], ...update(newLog[newLog.length - 1]) };
+      return newLog;
+    });
+  };
+
+  // Maps one server-sent pipeline event onto the in-progress log entry.
+  const handleEvent = (event, data) => {
+    switch (event) {
+      case "template":
+        updateLast(() => ({ status: `Running the ${data.api} template...`, code: data.code }));
+        break;
+      case "cache_hit":
+        updateLast(() => ({ status: "Running cached code...", code: data.code }));
+        break;
+      case "retrieved":
+        updateLast(() => ({ status: `Using ${data.docs.join(", ")}. Writing code...`, code: "" }));
+        break;
+      case "plan":
+        updateLast(() => ({ status: `Splitting into ${data.subtasks.length} tasks: ${data.subtasks.join(", ")}...` }));
+        break;
+      case "subtask":
+        updateLast(() => ({ status: `Finished "${data.query}" (${data.status})...` }));
+        break;
+      case "speculating":
+        updateLast(() => ({ status: `Trying ${data.candidates.length} approaches in parallel...` }));
+        break;
+      case "token":
+        updateLast(entry => ({ code: (entry.code || "") + data.text }));
+        break;
+      case "code":
+        updateLast(() => ({ code: data.code }));
+        break;
+      case "exec_start":
+        updateLast(() => ({ status: `Running code (attempt ${data.attempt})...`, output: "" }));
+        break;
+      case "stdout":
+        updateLast(entry => ({ output: (entry.output || "") + data.text }));
+        break;
+      case "triage":
+        updateLast(() => ({ status: data.action === "rerun" ? "Upstream API hiccup, running again..." : `Fixing the code (${data.reason})...` }));
+        break;
+      case "retry":
+        updateLast(() => ({ status: `Attempt failed, fixing the code (attempt ${data.attempt})...`, code: "" }));
+        break;
+      case "result":
+        updateLast(() => ({ a: data.result || data.error || "No response from server.", status: null }));
+        break;
+      default:
+        break;
+    }
+  };
+
   const send = async () => {
     if (!input || isLoading) return;
 
-    const userMessage = { q: input, a: null };
+    const userMessage = { q: input, a: null, status: "Finding the right API...", code: "", output: "" };
     setLog(prevLog => [...prevLog, userMessage]);
     setInput("");
     setIsLoading(true);
 
     try {
-      const { data } = await axios.post("http://localhost:8000/chat", { message: input });
-      const result = data.result || data.error || "No response from server.";
-      
-      setLog(prevLog => {
-        const newLog = [...prevLog];
-        newLog[newLog.length - 1].a = result;
-        return newLog;
+      const response = await fetch("http://localhost:8000/chat/stream", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ message: input }),
       });
+      if (!response.ok || !response.body) {
+        // 429/503 from admission control carry a JSON `error` and `retry_after`.
+        const body = await response.json().catch(() => null);
+        let message = body?.error || `Server responded with ${response.status}`;
+        const retryAfter = body?.retry_after ?? response.headers.get("Retry-After");
+        if (retryAfter) message += ` Try again in ${retryAfter}s.`;
+        throw new Error(message);
+      }
+
+      // Parse the Server-Sent Events stream as chunks arrive.
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      let gotResult = false;
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const messages = buffer.split("\n\n");
+        buffer = messages.pop();
+        for (const message of messages) {
+          const event = message.match(/^event: (.*)$/m)?.[1];
+          const data = message.match(/^data: (.*)$/m)?.[1];
+          if (event && data) {
+            handleEvent(event, JSON.parse(data));
+            if (event === "result") gotResult = true;
+          }
+        }
+      }
+      // The stream can end early (dropped connection, server error mid-stream).
+      if (!gotResult) {
+        throw new Error("The connection closed before a result arrived.");
+      }
 
     } catch (error) {
-      const errorMessage = error.response?.data?.error || error.message || "An unexpected error occurred.";
-       setLog(prevLog => {
-        const newLog = [...prevLog];
-        newLog[newLog.length - 1].a = `Error: ${errorMessage}`;
-        return newLog;
-      });
+      const errorMessage = error.message || "An unexpected error occurred.";
+      updateLast(() => ({ a: `Error: ${errorMessage}`, status: null }));
     } finally {
       setIsLoading(false);
     }
@@ -65,10 +146,19 @@ export default function Chat() {
             <div className="mt-1">
               <span className="font-semibold text-blue-600">API: </span>
               {l.a === null ? (
-                <div className="animate-pulse flex space-x-2 mt-2">
-                    <div className="h-2 w-2 bg-slate-300 rounded-full"></div>
-                    <div className="h-2 w-2 bg-slate-300 rounded-full"></div>
-                    <div className="h-2 w-2 bg-slate-300 rounded-full"></div>
+                <div className="mt-2">
+                  <div className="animate-pulse flex items-center space-x-2">
+                      <div className="h-2 w-2 bg-slate-300 rounded-full"></div>
+                      <div className="h-2 w-2 bg-slate-300 rounded-full"></div>
+                      <div className="h-2 w-2 bg-slate-300 rounded-full"></div>
+                      {l.status && <span className="text-sm text-gray-500">{l.status}</span>}
+                  </div>
+                  {l.code && (
+                    <pre className="mt-2 bg-gray-900 p-3 rounded-md text-xs text-gray-100 whitespace-pre-wrap break-words">{l.code}</pre>
+                  )}
+                  {l.output && (
+                    <pre className="mt-2 bg-gray-100 p-3 rounded-md text-sm text-gray-800 whitespace-pre-wrap break-words">{l.output}</pre>
+                  )}
                 </div>
               ) : (
                 <pre className="bg-gray-100 p-3 rounded-md text-sm text-gray-800 whitespace-pre-wrap break-words">{l.a}</pre>